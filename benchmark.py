@@ -0,0 +1,281 @@
+"""Benchmark the render path on synthetic flake images.
+
+Runs recorded parameter sweeps through the same render path as the window
+(and through the OpenGL renderer when a context is available) and reports
+per-stage latency, frames per second and peak memory. Runs without a
+display, on Mesa's llvmpipe when there is no GPU:
+
+    QT_QPA_PLATFORM=offscreen LIBGL_ALWAYS_SOFTWARE=1 python benchmark.py --megapixels 1 5 20 50 --json results.json
+
+Results written with --json can be passed to --compare on a later run to
+see the change per size and sweep.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import cv2
+import numpy as np
+from PySide6 import __version__ as pyside_version
+from PySide6.QtWidgets import QApplication
+from PySide6.QtGui import QImage, QOffscreenSurface, QOpenGLContext
+from PySide6.QtOpenGL import QOpenGLFramebufferObject
+
+import engine
+import main
+
+# Window attribute each sweep drives and its value for a frame, standing in
+# for a drag on the matching control
+SWEEPS = {
+    "angle": ("current_angle", lambda frame: frame * 1.5),
+    "scale": ("current_scale", lambda frame: 0.1 + 0.4 * (frame % 40) / 40.0),
+    "cut": ("cut_x_left", lambda frame: frame % 60),
+    "threshold": ("threshold1", lambda frame: 20 + (frame * 5) % 180),
+    "transparency": ("current_transparency", lambda frame: 255 - (frame * 4) % 200),
+}
+
+
+def make_flake_image(megapixels, seed=0):
+    # A few flat polygons on a noisy substrate, roughly what a flake looks like
+    rng = np.random.default_rng(seed)
+    width = int(round(math.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = width * 3 // 4
+    image = rng.normal(120, 6, (height, width, 3)).clip(0, 255).astype(np.uint8)
+    for _ in range(4):
+        center = rng.uniform((0.2 * width, 0.2 * height), (0.8 * width, 0.8 * height))
+        radius = rng.uniform(0.05, 0.2) * min(width, height)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 7))
+        points = center + radius * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        cv2.fillPoly(image, [points.astype(np.int32)], [int(c) for c in rng.integers(40, 220, 3)])
+    return image
+
+
+def bgr_to_qimage(image):
+    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return QImage(rgb.data, rgb.shape[1], rgb.shape[0], rgb.strides[0], QImage.Format_RGB888).copy()
+
+
+def load_sweep(args):
+    # One dict of window attributes per frame, recorded or generated
+    if args.sweep_file:
+        with open(args.sweep_file) as file:
+            return json.load(file)
+    attribute, value = SWEEPS[args.sweep]
+    return [{attribute: value(frame)} for frame in range(args.frames)]
+
+
+def reset_peak_memory():
+    # Linux lets the peak resident size be reset, so each run gets its own
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory_mb():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # Peak of the whole process so far, in kB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+class StageRecorder(object):
+    """Engine observer that keeps every stage time and cache hit."""
+
+    def __init__(self):
+        self.times = {}
+        self.hits = {}
+
+    def __call__(self, stage, seconds, hit):
+        if hit:
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+        else:
+            self.times.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        stages = {}
+        for stage in sorted(set(self.times) | set(self.hits)):
+            times = np.array(self.times.get(stage, [0.0])) * 1000.0
+            stages[stage] = {
+                "runs": len(self.times.get(stage, [])),
+                "hits": self.hits.get(stage, 0),
+                "median_ms": float(np.median(times)),
+                "p95_ms": float(np.percentile(times, 95)),
+            }
+        return stages
+
+
+def bench_cpu(window, image, sweep, args):
+    # Same zero-copy source as an opened file
+    window.set_layer_image(window.layer, image)
+    window.outline_enabled = args.outline
+    window.current_scale = args.scale
+    window.current_angle = 0.0
+    window.fast_preview = False
+    window.label_opacity = args.label_opacity
+    recorder = StageRecorder()
+    window.layer.engine.observer = recorder
+
+    times = []
+    for frame in sweep:
+        for attribute, value in frame.items():
+            setattr(window, attribute, value)
+        params = window.get_render_params()
+        for layer_params in params:
+            layer_params["backend"] = "label"
+        start = time.perf_counter()
+        window.render_stack(params)
+        times.append(time.perf_counter() - start)
+    window.layer.engine.observer = None
+    return times, recorder.summary()
+
+
+def bench_gl(window, image, sweep, args):
+    context = QOpenGLContext()
+    if not context.create():
+        return None
+    surface = QOffscreenSurface()
+    surface.setFormat(context.format())
+    surface.create()
+    context.makeCurrent(surface)
+    functions = context.functions()
+    width, height = args.viewport
+    fbo = QOpenGLFramebufferObject(width, height)
+    fbo.bind()
+    functions.glViewport(0, 0, width, height)
+
+    renderer = main.GLOverlayRenderer()
+    if not renderer.initialize(functions):
+        return None
+    # Uploads happen once per content change, like in the overlay window
+    renderer.set_texture("image", bgr_to_qimage(image), "image", 0)
+    window.current_scale = args.scale
+    window.current_angle = 0.0
+
+    times = []
+    outline_key = None
+    for frame in sweep:
+        for attribute, value in frame.items():
+            setattr(window, attribute, value)
+        start = time.perf_counter()
+        if args.outline and outline_key != (window.threshold1, window.threshold2):
+            outline_key = (window.threshold1, window.threshold2)
+            outline = engine.get_contour_image(image, window.threshold1, window.threshold2, window.outline_color)
+            renderer.set_texture("outline", engine.FrameBuffers().wrap("outline", outline), outline_key, 0)
+        renderer.set_geometry((window.cut_x_left, window.cut_x_right, window.cut_y_top, window.cut_y_bottom), window.current_scale,
+                              window.current_angle, window.mirror_enabled, window.current_transparency / 255.0, args.outline, True)
+        renderer.clear()
+        renderer.paint(width, height)
+        functions.glFinish()
+        times.append(time.perf_counter() - start)
+
+    renderer.cleanup()
+    fbo.release()
+    context.doneCurrent()
+    return times
+
+
+def frame_stats(times):
+    # The first frame builds the caches and the pyramid, keep it out
+    times = np.array(times[1:] or times) * 1000.0
+    return {
+        "frames": len(times),
+        "median_ms": float(np.median(times)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "fps": float(1000.0 / np.mean(times)),
+    }
+
+
+def summarize(stats):
+    return "%8.2f ms median %8.2f ms p95 %7.1f fps" % (stats["median_ms"], stats["p95_ms"], stats["fps"])
+
+
+def run_key(result):
+    return (result["megapixels"], result["sweep"], result["outline"], result["path"])
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as file:
+        baseline = {run_key(result): result for result in json.load(file)["results"]}
+    print("Compared with %s (median frame time, new / old):" % baseline_file)
+    for result in results:
+        old = baseline.get(run_key(result))
+        if old is None:
+            continue
+        ratio = result["frame"]["median_ms"] / max(old["frame"]["median_ms"], 1e-9)
+        print("  %5.1f MP %-9s %-6s %5.2fx%s" % (result["megapixels"], result["sweep"], result["path"], ratio,
+                                              "  slower" if ratio > 1.1 else ""))
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--sweep", choices=sorted(SWEEPS), default="angle")
+    parser.add_argument("--sweep-file", help="JSON list with one {window attribute: value} dict per frame, replaces --sweep")
+    parser.add_argument("--scale", type=float, default=0.25)
+    parser.add_argument("--outline", action="store_true")
+    parser.add_argument("--label-opacity", action="store_true", help="leave opacity to the label, as the window does by default, instead of timing the opacity stage")
+    parser.add_argument("--viewport", type=int, nargs=2, default=[1024, 1024])
+    parser.add_argument("--no-gl", action="store_true", help="skip the OpenGL renderer")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier --json run to compare with")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    window = main.MainWindow()
+    sweep = load_sweep(args)
+    sweep_name = os.path.basename(args.sweep_file) if args.sweep_file else args.sweep
+    results = []
+    for megapixels in args.megapixels:
+        image = make_flake_image(megapixels)
+        print("%5.1f MP (%dx%d), %s sweep%s" % (megapixels, image.shape[1], image.shape[0], sweep_name, ", outline" if args.outline else ""))
+        run = {"megapixels": megapixels, "width": image.shape[1], "height": image.shape[0], "sweep": sweep_name, "outline": args.outline}
+
+        reset_peak_memory()
+        times, stages = bench_cpu(window, image, sweep, args)
+        results.append(dict(run, path="cpu", frame=frame_stats(times), stages=stages, peak_memory_mb=peak_memory_mb()))
+        print("  cpu    " + summarize(results[-1]["frame"]) + "  peak %.0f MB" % results[-1]["peak_memory_mb"])
+        for stage, stats in stages.items():
+            print("    %-9s %8.2f ms median %8.2f ms p95 %4d runs %4d hits" % (stage, stats["median_ms"], stats["p95_ms"], stats["runs"], stats["hits"]))
+
+        reset_peak_memory()
+        gl_times = None if args.no_gl else bench_gl(window, image, sweep, args)
+        if gl_times is None:
+            print("  opengl not available")
+        else:
+            results.append(dict(run, path="opengl", frame=frame_stats(gl_times), stages={}, peak_memory_mb=peak_memory_mb()))
+            print("  opengl " + summarize(results[-1]["frame"]))
+    window.close_all_windows()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "pyside": pyside_version,
+                "opencv": cv2.__version__,
+                "platform": platform.platform(),
+                "args": vars(args),
+                "results": results,
+            }, file, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,1121 @@
+"""Image pipeline of the overlay, independent of any widget.
+
+Engine turns an image and a RenderParams into a frame: crop, outline, scale,
+rotate and opacity, each stage cached. It only uses QImage from QtGui, so it
+runs on the render thread, in batch workers and on machines without a display.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PySide6.QtCore import Qt, QPointF, QRectF, QSize
+from PySide6.QtGui import QColor, QImage, QPainter, QPainterPath, QPen, QPolygonF, QTransform
+
+# BGRA outline colors, as laid out in memory for QImage.Format_ARGB32
+OUTLINE_COLORS = {
+    "White": [255, 255, 255, 255],
+    "Blue": [255, 0, 0, 255],
+    "Yellow": [0, 255, 255, 255],
+    "Red": [0, 0, 255, 255],
+    "Green": [0, 255, 0, 255],
+    "Gold": [0, 215, 255, 255],
+    "Black": [0, 0, 0, 255]
+}
+
+# 256-entry lookup tables indexed by the Canny edge map: 0 is transparent,
+# anything else is the outline color
+OUTLINE_LUTS = {}
+for _name, _color in OUTLINE_COLORS.items():
+    OUTLINE_LUTS[_name] = np.zeros((256, 4), dtype=np.uint8)
+    OUTLINE_LUTS[_name][1:] = _color
+
+
+# cv2.imread flags per decode reduction; reduced decodes are always BGR
+DECODE_FLAGS = {
+    1: cv2.IMREAD_UNCHANGED,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Files at least this large are memory-mapped for decoding instead of being
+# read into a buffer first, so the encoded bytes never sit in memory twice
+MEMMAP_THRESHOLD = 256 * 1024 * 1024
+
+
+def decode_image_file(file_name, reduction=1, progress=None, chunk_size=8 * 1024 * 1024):
+    """Decode an image file once into an 8-bit gray, BGR or BGRA array.
+
+    progress, if given, is called with a percentage while the file is read.
+    Returns None if the file is not an image.
+    """
+    size = os.path.getsize(file_name)
+    if size >= MEMMAP_THRESHOLD:
+        data = np.memmap(file_name, dtype=np.uint8, mode="r")
+    else:
+        data = np.empty(size, dtype=np.uint8)
+        with open(file_name, "rb") as file:
+            for offset in range(0, size, chunk_size):
+                file.readinto(memoryview(data)[offset:offset + chunk_size])
+                if progress is not None:
+                    progress(90 * min(offset + chunk_size, size) // max(size, 1))
+    image = cv2.imdecode(data, DECODE_FLAGS[reduction]) if size else None
+    del data
+    if image is None:
+        # Formats OpenCV cannot decode, e.g. some GIFs, still work through Qt
+        qimage = QImage(file_name)
+        if qimage.isNull():
+            return None
+        image = qimage_to_array(qimage)
+        if reduction > 1:
+            image = cv2.resize(image, ((image.shape[1] + reduction - 1) // reduction, (image.shape[0] + reduction - 1) // reduction), interpolation=cv2.INTER_AREA)
+    image = to_8bit(image)
+    if progress is not None:
+        progress(100)
+    return np.ascontiguousarray(image)
+
+
+def to_8bit(image, value_range=None):
+    # Other types are stretched to their own range, or to value_range, a
+    # (low, high) shared by all the pieces of a mosaic
+    if image.dtype == np.uint16:
+        return (image >> 8).astype(np.uint8)
+    if image.dtype != np.uint8:
+        if value_range is None:
+            return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        low, high = value_range
+        scale = 255.0 / (high - low) if high > low else 0.0
+        return np.clip((image.astype(np.float32) - low) * scale + 0.5, 0, 255).astype(np.uint8)
+    return image
+
+
+def get_value_range(images):
+    # One (low, high) over several arrays, None if 8 or 16 bit need none
+    low, high = None, None
+    for image in images:
+        if image.dtype in (np.uint8, np.uint16):
+            return None
+        low = float(image.min()) if low is None else min(low, float(image.min()))
+        high = float(image.max()) if high is None else max(high, float(image.max()))
+    return low, high
+
+
+def check_image_array(shape, dtype, name):
+    # Gray, BGR or BGRA with real values, as the rest of the pipeline takes
+    if len(shape) not in (2, 3) or (len(shape) == 3 and shape[2] not in (3, 4)) or 0 in shape[:2] or dtype.kind not in "buif":
+        raise ValueError(f"{name}: not a gray, BGR or BGRA image (shape {shape}, {dtype})")
+
+
+def array_to_qimage(image):
+    # A view on the array, no copy: gray, BGR or BGRA (ARGB32 in memory)
+    formats = {1: QImage.Format_Grayscale8, 3: QImage.Format_BGR888, 4: QImage.Format_ARGB32}
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    return QImage(image.data, image.shape[1], image.shape[0], image.strides[0], formats[channels])
+
+
+def to_gray(image):
+    # Accept gray, BGR or BGRA images
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+
+class RenderParams(object):
+    """Everything a frame depends on besides the image itself.
+
+    cuts are the cut sliders in percent (x left, x right, y top, y bottom),
+    alpha is the opacity from 0 to 255. With bake_alpha False the caller
+    applies the opacity itself, e.g. when compositing. With vector the
+    outline is traced into polylines, simplified by up to tolerance pixels,
+    and painted under the transform instead of being resampled. With segment
+    the outline is the boundary of segmented flakes instead of the Canny
+    edges: flake 1 is the largest, 2 the next and so on, 0 outlines all.
+    """
+
+    def __init__(self, scale=1.0, angle=0.0, cuts=(0, 100, 0, 100), mirror=False, outline=False,
+                 threshold1=100, threshold2=200, color="White", alpha=255, smooth=True, bake_alpha=True,
+                 vector=False, tolerance=1.0, segment=False, flake=1, color_space="Lab", min_area=500):
+        self.scale = scale
+        self.angle = angle
+        self.cuts = tuple(cuts)
+        self.mirror = mirror
+        self.outline = outline
+        self.threshold1 = threshold1
+        self.threshold2 = threshold2
+        self.color = color
+        self.alpha = alpha
+        self.smooth = smooth
+        self.bake_alpha = bake_alpha
+        self.vector = vector
+        self.tolerance = tolerance
+        self.segment = segment
+        self.flake = flake
+        self.color_space = color_space
+        self.min_area = min_area
+
+    def replace(self, **changes):
+        return RenderParams(**dict(vars(self), **changes))
+
+    def outline_key(self):
+        # What the edge map depends on; the color is applied afterwards
+        if self.segment:
+            return ("segment", self.color_space, self.min_area, self.flake)
+        return (self.threshold1, self.threshold2)
+
+
+class FrameBuffers(object):
+    """Reusable NumPy frame buffers shared with QImage.
+
+    Every QImage made by wrap() holds a reference to its array, so the array
+    lives as long as the image. A buffer is handed out again only when the
+    image on screen no longer points into it.
+    """
+
+    def __init__(self, count=2):
+        self.count = count
+        self.slots = {}
+        # cacheKey of the image on screen; shallow copies share the key
+        self.displayed_key = None
+
+    def acquire(self, name, shape):
+        slots = [slot for slot in self.slots.get(name, []) if slot[0].shape == shape]
+        for slot in slots:
+            if slot[1] is None or slot[1].cacheKey() != self.displayed_key:
+                return slot[0]
+        slot = [np.empty(shape, dtype=np.uint8), None]
+        self.slots[name] = (slots + [slot])[-self.count:]
+        return slot[0]
+
+    def wrap(self, name, array, image_format=QImage.Format_ARGB32):
+        # A fresh QImage per use, so nothing keyed on cacheKey sees stale pixels
+        qimage = QImage(array.data, array.shape[1], array.shape[0], array.strides[0], image_format)
+        for slot in self.slots.get(name, []):
+            if slot[0] is array:
+                slot[1] = qimage
+        return qimage
+
+
+def get_contour_image(image, threshold1, threshold2, color_name, out=None):
+    return colorize_edges(detect_edges(image, threshold1, threshold2), color_name, out=out)
+
+
+def detect_edges(image, threshold1, threshold2):
+    return cv2.Canny(to_gray(image), threshold1, threshold2)
+
+
+def get_gradients(gray):
+    # Sobel derivatives exactly as cv2.Canny takes them internally, so that
+    # Canny on them matches Canny on the image but skips the Sobel pass
+    return np.stack([cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE),
+                     cv2.Sobel(gray, cv2.CV_16S, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE)])
+
+
+def detect_edges_from_gradients(gradients, threshold1, threshold2):
+    # Only non-maximum suppression and hysteresis run
+    return cv2.Canny(gradients[0], gradients[1], threshold1, threshold2)
+
+
+def colorize_edges(edges, color_name, out=None):
+    if out is None or out.shape[:2] != edges.shape:
+        out = np.empty((edges.shape[0], edges.shape[1], 4), dtype=np.uint8)
+
+    # Look every edge value up in the color table: one write per pixel,
+    # no masks, straight into the (possibly reused) output buffer
+    lut = OUTLINE_LUTS.get(color_name, OUTLINE_LUTS["White"])
+    np.take(lut, edges, axis=0, out=out, mode="clip")
+
+    return out
+
+
+# Threshold pairs tried by sweep_thresholds, over the range of the sliders
+THRESHOLD_GRID = [(low, high) for low in range(5, 100, 5) for high in range(low + 5, 101, 5)]
+
+
+# Counts the 8 neighbours of a pixel, plus 10 for the pixel itself
+ENDPOINT_KERNEL = np.array([[1, 1, 1], [1, 10, 1], [1, 1, 1]], dtype=np.float32)
+
+
+def score_edges(edges, min_length=20):
+    """Continuity of a Canny edge map, higher is better.
+
+    Edge pixels in connected chains of at least min_length pixels are
+    outline, shorter fragments are substrate texture or dust. The score
+    rewards a high share of outline pixels and long chains, penalizes loose
+    chain ends (closed outlines have none), and falls off once edges cover
+    more than a few percent of the image, which is texture rather than
+    outline.
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(edges, connectivity=8)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    chains = areas[areas >= min_length]
+    if not len(chains):
+        return 0.0
+    continuity = chains.sum() / areas.sum()
+    density = areas.sum() / edges.size
+    # Loose ends: closed outlines have none, spurs and breaks add them
+    neighbours = cv2.filter2D((edges > 0).astype(np.uint8), cv2.CV_8U, ENDPOINT_KERNEL)
+    ends = np.count_nonzero(neighbours == 11)
+    return float(continuity ** 2 * np.log1p(chains.mean()) / (1.0 + ends / len(chains)) / (1.0 + density / 0.05))
+
+
+def get_preview_array(image, max_size):
+    # The image at most max_size pixels on its longer side
+    if isinstance(image, TiledImage):
+        level = 0
+        while max(image.level_size(level)) > max_size:
+            level += 1
+        image = image.read_region(level, 0, 0, image.width(), image.height())
+    scale = max_size / max(image.shape[:2])
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+
+def sweep_thresholds(image, pairs=THRESHOLD_GRID, max_size=1024, workers=None, count=6):
+    """Score Canny threshold pairs on a downsampled copy of image.
+
+    Returns the best count (score, threshold1, threshold2, edges) tuples,
+    best first, one per distinct edge map (the best scoring pair that
+    produced it), and the downsampled image the edges belong to. The pairs
+    run on a thread pool, OpenCV releases the GIL.
+    """
+    preview = get_preview_array(image, max_size)
+    gradients = get_gradients(to_gray(preview))
+
+    def evaluate(pair):
+        # Only a digest of the edge map is kept; the winners are redone
+        edges = detect_edges_from_gradients(gradients, *pair)
+        return score_edges(edges), pair[0], pair[1], hashlib.blake2b(edges, digest_size=16).digest()
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        results = sorted(pool.map(evaluate, pairs), key=lambda result: -result[0])
+    distinct = {}
+    for score, threshold1, threshold2, digest in results:
+        distinct.setdefault(digest, (score, threshold1, threshold2))
+        if len(distinct) == count:
+            break
+    candidates = [(score, threshold1, threshold2, detect_edges_from_gradients(gradients, threshold1, threshold2))
+                  for score, threshold1, threshold2 in distinct.values()]
+    return candidates, preview
+
+
+# Conversions for segment_flakes, from BGR
+SEGMENT_COLOR_SPACES = {
+    "Lab": cv2.COLOR_BGR2LAB,
+    "HSV": cv2.COLOR_BGR2HSV,
+    "BGR": None,
+    "Gray": cv2.COLOR_BGR2GRAY,
+}
+
+
+def segment_flakes(image, color_space="Lab", min_area=500):
+    """Label the regions that stand out from the substrate, largest first.
+
+    The substrate is taken to be the median color; pixels whose distance to
+    it passes Otsu's threshold are cleaned up with an opening and a closing,
+    and connected regions smaller than min_area pixels are dropped. Returns
+    an int32 label image, 0 for the substrate and 1 for the largest flake.
+    """
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    elif image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    conversion = SEGMENT_COLOR_SPACES.get(color_space)
+    if conversion is not None:
+        image = cv2.cvtColor(image, conversion)
+    pixels = image.reshape(image.shape[0], image.shape[1], -1).astype(np.float32)
+    # Every 16th pixel is plenty for the median of a mostly flat substrate
+    substrate = np.median(pixels.reshape(-1, pixels.shape[2])[::16], axis=0)
+    difference = pixels - substrate
+    distance = cv2.sqrt(np.einsum("ijk,ijk->ij", difference, difference))
+    distance = cv2.normalize(distance, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+    _, mask = cv2.threshold(distance, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    mask = cv2.morphologyEx(cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel), cv2.MORPH_CLOSE, kernel)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    order = np.argsort(-areas, kind="stable")
+    order = order[areas[order] >= min_area]
+    # Relabel by size, the dropped regions become substrate
+    ranks = np.zeros(count, dtype=np.int32)
+    ranks[order + 1] = np.arange(1, len(order) + 1)
+    return ranks[labels]
+
+
+def get_flake_boundaries(labels):
+    # Label of every flake pixel that has a 4-neighbour with another label
+    # (the image border counts as substrate), 0 elsewhere
+    padded = np.pad(labels, 1)
+    inner = padded[1:-1, 1:-1]
+    edge = (inner != padded[:-2, 1:-1]) | (inner != padded[2:, 1:-1]) | (inner != padded[1:-1, :-2]) | (inner != padded[1:-1, 2:])
+    return np.where(edge, inner, 0)
+
+
+def select_flakes(boundaries, flake):
+    # A lookup on the cached boundaries: 255 on the selected flake, 0 = all
+    lut = np.zeros(int(boundaries.max()) + 1, dtype=np.uint8)
+    if flake == 0:
+        lut[1:] = 255
+    elif flake < len(lut):
+        lut[flake] = 255
+    return np.take(lut, boundaries)
+
+
+def get_level_size(width, height, level):
+    # Same size convention as cv2.pyrDown
+    for _ in range(level):
+        width, height = (width + 1) // 2, (height + 1) // 2
+    return width, height
+
+
+def trace_contours(edges, tolerance=0.0):
+    # One (n, 2) point array per edge chain; approxPolyDP drops the points
+    # within tolerance pixels of a straight line
+    contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    if tolerance > 0:
+        contours = [cv2.approxPolyDP(contour, tolerance, False) for contour in contours]
+    return [contour.reshape(-1, 2) for contour in contours]
+
+
+def contours_to_path(contours):
+    # Through the pixel centers, so the path lies on the raster outline
+    path = QPainterPath()
+    for points in contours:
+        polygon = QPolygonF([QPointF(x + 0.5, y + 0.5) for x, y in points.tolist()])
+        if len(points) > 2:
+            polygon.append(polygon[0])
+        path.addPolygon(polygon)
+    return path
+
+
+def get_outline_pen(color_name):
+    # Cosmetic: one device pixel wide at any scale
+    blue, green, red, alpha = OUTLINE_COLORS.get(color_name, OUTLINE_COLORS["White"])
+    pen = QPen(QColor(red, green, blue, alpha), 0)
+    pen.setCosmetic(True)
+    return pen
+
+
+class VectorOutline(object):
+    """Outline of a width x height region as a QPainterPath in its pixels."""
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.size = QSize(width, height)
+
+    def width(self):
+        return self.size.width()
+
+    def height(self):
+        return self.size.height()
+
+    def render(self, scale, angle, mirror, color_name, smooth):
+        # Same geometry as scale_image and rotate_image on the raster outline,
+        # but the cost is in the vertices, not the pixels
+        transform = QTransform().rotate(angle)
+        if mirror:
+            transform.scale(-1, 1)
+        transform.scale(scale, scale)
+        rect = transform.mapRect(QRectF(0, 0, self.width(), self.height()))
+        image = QImage(max(1, round(rect.width())), max(1, round(rect.height())), QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing, smooth)
+        painter.translate(-rect.x(), -rect.y())
+        painter.setTransform(transform, True)
+        painter.setPen(get_outline_pen(color_name))
+        painter.drawPath(self.path)
+        painter.end()
+        return image
+
+
+def get_crop_rect(width, height, cuts):
+    # Cut sliders mapped to (x, y, width, height) in source pixels, clipped
+    # to the image and never empty
+    cut_x_left, cut_x_right, cut_y_top, cut_y_bottom = cuts
+    x = min(int(width * cut_x_left / 100), width - 1)
+    y = min(int(height * cut_y_top / 100), height - 1)
+    w = max(1, min(int(width * cut_x_right / 100), width - x))
+    h = max(1, min(int(height * cut_y_bottom / 100), height - y))
+    return (x, y, w, h)
+
+
+def get_pyramid_level(width, height, scale):
+    # Smallest level that is still at or above the requested scale
+    level = 0
+    while scale <= 0.5 ** (level + 1) and min(width, height) >> (level + 1) > 0:
+        level += 1
+    return level
+
+
+def get_content_key(source, generation, params):
+    # Identifies what a paint-time backend needs uploaded: the level of the
+    # source or of the outline, independent of the geometry
+    key = (generation, get_source_level(source, params.scale, content_only=True), params.outline)
+    if params.outline:
+        key += params.outline_key() + (params.color,)
+        if params.vector:
+            key += (params.tolerance,)
+    return key
+
+
+def crop_image(image, crop):
+    # Create a new image for the cropped area of the source
+    return image.copy(*crop)
+
+
+def scale_image(image, scale, quality):
+    return image.scaled(image.size() * scale, Qt.KeepAspectRatio, quality)
+
+
+def rotate_image(image, angle, mirror, quality):
+    transform = QTransform().rotate(angle)
+    if mirror:
+        transform.scale(-1, 1)
+    return image.transformed(transform, quality)
+
+
+def apply_opacity(image, alpha):
+    transparent_image = QImage(image.size(), QImage.Format_ARGB32_Premultiplied)
+    transparent_image.fill(Qt.transparent)
+
+    painter = QPainter(transparent_image)
+    painter.setOpacity(alpha / 255.0)
+    painter.drawImage(0, 0, image)
+    painter.end()
+    return transparent_image
+
+
+def compose_images(images, alphas):
+    # Images are centered on each other, bottom to top
+    width = max(image.width() for image in images)
+    height = max(image.height() for image in images)
+    composed_image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+    composed_image.fill(Qt.transparent)
+
+    painter = QPainter(composed_image)
+    for image, alpha in zip(images, alphas):
+        painter.setOpacity(alpha / 255.0)
+        painter.drawImage((width - image.width()) // 2, (height - image.height()) // 2, image)
+    painter.end()
+    return composed_image
+
+
+def qimage_to_array(image):
+    # Height x width x 4 copy in BGRA byte order, premultiplied alpha undone
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    array = np.frombuffer(image.constBits(), dtype=np.uint8, count=image.sizeInBytes())
+    return array.reshape(image.height(), image.bytesPerLine())[:, :image.width() * 4].reshape(image.height(), image.width(), 4).copy()
+
+
+class FrameProfiler(object):
+    """Rolling stage and frame timings; an instance works as Engine.observer.
+
+    The last `window` samples of every stage give the percentiles, hit rates
+    and histogram, the last `trace_size` events go into save_trace(). Stages
+    are reported from the render thread and read from the GUI thread.
+    """
+    # Frame time histogram bucket edges in ms
+    HISTOGRAM_EDGES = (0, 2, 4, 8, 16, 33, 50, 100, 200, 500, float("inf"))
+
+    def __init__(self, window=240, trace_size=20000):
+        self.window = window
+        self.lock = threading.Lock()
+        # name -> deque of (seconds, hit); "frame" holds whole frames
+        self.samples = {}
+        self.trace = deque(maxlen=trace_size)
+        self.origin = time.perf_counter()
+
+    def __call__(self, stage, seconds, hit):
+        self.add(stage, seconds, hit)
+
+    def add(self, name, seconds, hit=False):
+        end = time.perf_counter()
+        with self.lock:
+            self.samples.setdefault(name, deque(maxlen=self.window)).append((seconds, hit))
+            if not hit:
+                # Chrome trace "complete" event, microseconds since the start
+                self.trace.append({"name": name, "ph": "X", "pid": 0, "tid": threading.get_ident(),
+                                   "ts": (end - seconds - self.origin) * 1e6, "dur": seconds * 1e6})
+
+    def add_frame(self, seconds):
+        self.add("frame", seconds)
+
+    def summary(self):
+        # name -> runs, hits, hit rate and p50/p95 of the runs in ms
+        with self.lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+        summary = {}
+        for name, values in samples.items():
+            times = np.array([seconds for seconds, hit in values if not hit] or [0.0]) * 1000.0
+            hits = sum(1 for seconds, hit in values if hit)
+            summary[name] = {
+                "runs": len(values) - hits,
+                "hits": hits,
+                "hit_rate": hits / float(len(values)),
+                "p50_ms": float(np.percentile(times, 50)),
+                "p95_ms": float(np.percentile(times, 95)),
+            }
+            if name == "frame":
+                summary[name]["histogram"] = np.histogram(times, bins=self.HISTOGRAM_EDGES)[0].tolist()
+        return summary
+
+    def save_trace(self, path):
+        # Opens in chrome://tracing and ui.perfetto.dev
+        with self.lock:
+            events = list(self.trace)
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"summary": self.summary(), "histogram_edges_ms": [str(edge) for edge in self.HISTOGRAM_EDGES]}}, file)
+
+
+class NpyReader(object):
+    """Level 0 pixels of a .npy array (H x W, H x W x 3 BGR or x 4 BGRA),
+    memory-mapped so only the regions that are read get paged in."""
+    tile_size = None
+
+    def __init__(self, file_name):
+        self.array = np.load(file_name, mmap_mode="r")
+        check_image_array(self.array.shape, self.array.dtype, file_name)
+        self.shape = self.array.shape
+        # One pass over the file, so every region is scaled alike
+        self.value_range = get_value_range([self.array])
+
+    def read(self, x0, y0, x1, y1):
+        return to_8bit(np.ascontiguousarray(self.array[y0:y1, x0:x1]), self.value_range)
+
+
+class TileDirectoryReader(object):
+    """Level 0 pixels of a mosaic stored as one image file per grid cell,
+    named r<row>_c<column>.<ext>. Files are only decoded when read; missing
+    cells are black."""
+    TILE_NAME = re.compile(r"r(\d+)_c(\d+)\.\w+$", re.IGNORECASE)
+
+    def __init__(self, directory):
+        self.files = {}
+        for name in os.listdir(directory):
+            match = self.TILE_NAME.search(name)
+            if match:
+                self.files[(int(match.group(1)), int(match.group(2)))] = os.path.join(directory, name)
+        if not self.files:
+            raise IOError(f"No r<row>_c<column> tiles in {directory}")
+        rows = max(row for row, column in self.files) + 1
+        columns = max(column for row, column in self.files) + 1
+        first = self.decode_raw(min(self.files))
+        if first is None:
+            raise IOError(f"Cannot read {self.files[min(self.files)]}")
+        check_image_array(first.shape, first.dtype, self.files[min(self.files)])
+        # Tiles beyond 16 bit share one range, which means decoding them all
+        # once here; per tile ranges would show as seams
+        self.value_range = None
+        if first.dtype not in (np.uint8, np.uint16):
+            self.value_range = get_value_range(image for image in map(self.decode_raw, self.files) if image is not None)
+        first = to_8bit(first, self.value_range)
+        # All cells share the size of the first one, except the last row and
+        # column, which may be cut short
+        tile_height, tile_width = first.shape[:2]
+        last_width = self.decode_size(0, columns - 1, tile_width, tile_height)[0]
+        last_height = self.decode_size(rows - 1, 0, tile_width, tile_height)[1]
+        self.tile_size = (tile_width, tile_height)
+        self.channels = first.shape[2:]
+        self.shape = ((rows - 1) * tile_height + last_height, (columns - 1) * tile_width + last_width) + self.channels
+
+    def decode_raw(self, cell):
+        return cv2.imread(self.files[cell], cv2.IMREAD_UNCHANGED) if cell in self.files else None
+
+    def decode(self, cell):
+        image = self.decode_raw(cell)
+        return None if image is None else to_8bit(image, self.value_range)
+
+    def decode_size(self, row, column, tile_width, tile_height):
+        image = self.decode((row, column))
+        return (tile_width, tile_height) if image is None else (image.shape[1], image.shape[0])
+
+    def read(self, x0, y0, x1, y1):
+        tile_width, tile_height = self.tile_size
+        region = np.zeros((y1 - y0, x1 - x0) + self.channels, dtype=np.uint8)
+        for row in range(y0 // tile_height, (y1 - 1) // tile_height + 1):
+            for column in range(x0 // tile_width, (x1 - 1) // tile_width + 1):
+                image = self.decode((row, column))
+                if image is None:
+                    continue
+                if image.shape[2:] != self.channels:
+                    image = to_gray(image) if not self.channels else cv2.cvtColor(to_gray(image), cv2.COLOR_GRAY2BGR)
+                top, left = row * tile_height, column * tile_width
+                ys, xs = max(y0, top), max(x0, left)
+                ye, xe = min(y1, top + image.shape[0]), min(x1, left + image.shape[1])
+                region[ys - y0:ye - y0, xs - x0:xe - x0] = image[ys - top:ye - top, xs - left:xe - left]
+        return region
+
+
+class TiledImage(object):
+    """Pyramid of fixed-size tiles over a reader, built and cached on demand.
+
+    Level k is the image halved k times (cv2.pyrDown size convention); a tile
+    of level k is made from the four tiles below it, so any region costs only
+    the tiles it touches. Pixel and edge tiles share one LRU cache with a
+    byte budget. width() and height() make it usable as an Engine source.
+    """
+    # Extra pixels around a tile for Canny, so edges continue across tiles
+    EDGE_OVERLAP = 16
+
+    def __init__(self, reader, tile_size=512, cache_bytes=512 * 1024 * 1024):
+        self.reader = reader
+        # Tiles line up with the files of a tile directory
+        self.tile_size = reader.tile_size or (tile_size, tile_size)
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.channels = reader.shape[2:]
+
+    def width(self):
+        return self.reader.shape[1]
+
+    def height(self):
+        return self.reader.shape[0]
+
+    def level_size(self, level):
+        return get_level_size(self.width(), self.height(), level)
+
+    def cached(self, key, build):
+        # The render thread and an auto threshold sweep can read at once.
+        # Builds run unlocked, they read tiles themselves; a tile built twice
+        # at the same time is simply kept once.
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        value = build()
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = value
+                self.cached_bytes += value.nbytes
+            while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+                self.cached_bytes -= self.cache.popitem(last=False)[1].nbytes
+        return value
+
+    def tile(self, level, column, row):
+        return self.cached(("tile", level, column, row), lambda: self.build_tile(level, column, row))
+
+    def build_tile(self, level, column, row):
+        tile_width, tile_height = self.tile_size
+        width, height = self.level_size(level)
+        x0, y0 = column * tile_width, row * tile_height
+        x1, y1 = min(x0 + tile_width, width), min(y0 + tile_height, height)
+        if level == 0:
+            return self.reader.read(x0, y0, x1, y1)
+        # Half of the matching 2 x 2 block of the level below
+        below = self.read_region(level - 1, 2 * x0, 2 * y0, 2 * (x1 - x0), 2 * (y1 - y0))
+        return cv2.resize(below, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+
+    def read_region(self, level, x, y, w, h):
+        # Pixels of (x, y, w, h) at a level, clipped to the image
+        width, height = self.level_size(level)
+        w, h = min(w, width - x), min(h, height - y)
+        return self.assemble(lambda column, row: self.tile(level, column, row), x, y, w, h, self.channels)
+
+    def read_edges(self, level, x, y, w, h, threshold1, threshold2):
+        return self.assemble(lambda column, row: self.edge_tile(level, column, row, threshold1, threshold2), x, y, w, h, ())
+
+    def edge_tile(self, level, column, row, threshold1, threshold2):
+        return self.cached(("edges", level, column, row, threshold1, threshold2), lambda: self.build_edge_tile(level, column, row, threshold1, threshold2))
+
+    def build_edge_tile(self, level, column, row, threshold1, threshold2):
+        # Canny over the tile plus an overlap taken from its neighbours, then
+        # cut back to the tile, so there are no seams along tile borders
+        tile_width, tile_height = self.tile_size
+        width, height = self.level_size(level)
+        x0, y0 = column * tile_width, row * tile_height
+        x1, y1 = min(x0 + tile_width, width), min(y0 + tile_height, height)
+        ox0, oy0 = max(0, x0 - self.EDGE_OVERLAP), max(0, y0 - self.EDGE_OVERLAP)
+        ox1, oy1 = min(width, x1 + self.EDGE_OVERLAP), min(height, y1 + self.EDGE_OVERLAP)
+        # The gradients stay cached, new thresholds only redo the hysteresis
+        gradients = self.cached(("gradient", level, column, row),
+                                lambda: get_gradients(to_gray(self.read_region(level, ox0, oy0, ox1 - ox0, oy1 - oy0))))
+        edges = detect_edges_from_gradients(gradients, threshold1, threshold2)
+        return np.ascontiguousarray(edges[y0 - oy0:y1 - oy0, x0 - ox0:x1 - ox0])
+
+    def assemble(self, get_tile, x, y, w, h, channels):
+        tile_width, tile_height = self.tile_size
+        region = np.empty((h, w) + channels, dtype=np.uint8)
+        for row in range(y // tile_height, (y + h - 1) // tile_height + 1):
+            for column in range(x // tile_width, (x + w - 1) // tile_width + 1):
+                tile = get_tile(column, row)
+                left, top = column * tile_width, row * tile_height
+                xs, ys = max(x, left), max(y, top)
+                xe, ye = min(x + w, left + tile.shape[1]), min(y + h, top + tile.shape[0])
+                region[ys - y:ye - y, xs - x:xe - x] = tile[ys - top:ye - top, xs - left:xe - left]
+        return region
+
+
+def open_image_source(file_name, reduction=1, progress=None):
+    """Decoded array for ordinary images, TiledImage for .npy files and
+    tile directories, None if file_name is not an image."""
+    if os.path.isdir(file_name):
+        return TiledImage(TileDirectoryReader(file_name))
+    if file_name.lower().endswith(".npy"):
+        return TiledImage(NpyReader(file_name))
+    return decode_image_file(file_name, reduction, progress)
+
+
+def hash_file(file_name, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache(object):
+    """Content-addressed arrays on disk, as memory-mappable .npy files.
+
+    An entry is <key>-<name>.npy, where key identifies the content, e.g. the
+    digest of an image file and the decode reduction. Reading an entry
+    refreshes its modification time, and writing one deletes the least
+    recently used entries until the directory is within max_bytes. Entries
+    are written under a temporary name and renamed, so threads and processes
+    can share a directory.
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, name):
+        return os.path.join(self.directory, f"{key}-{name}.npy")
+
+    def get(self, key, name):
+        path = self.path(key, name)
+        try:
+            array = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return array
+
+    def put(self, key, name, array):
+        path = self.path(key, name)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "wb") as file:
+                np.save(file, array)
+            os.replace(temporary, path)
+        except OSError as error:
+            # The cache is optional, a full or read-only disk only costs speed
+            warnings.warn(f"Disk cache write failed: {error}", RuntimeWarning)
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+        self.evict()
+
+    def get_or_build(self, key, name, build):
+        array = self.get(key, name)
+        if array is None:
+            array = build()
+            self.put(key, name, array)
+        return array
+
+    def evict(self):
+        entries = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".npy"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        # Evicted by another process meanwhile
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as error:
+            warnings.warn(f"Disk cache eviction failed: {error}", RuntimeWarning)
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Still mapped on a system that does not allow removing it
+                continue
+            total -= size
+
+
+def load_image_source(file_name, reduction=1, progress=None, disk_cache=None):
+    """open_image_source through a disk cache: returns (image, digest).
+
+    The digest identifies the decoded content and keys the disk cache
+    entries of everything computed from it; it is None without a cache and
+    for tiled sources, which are read from disk as they are.
+    """
+    if disk_cache is None or os.path.isdir(file_name) or file_name.lower().endswith(".npy"):
+        return open_image_source(file_name, reduction, progress), None
+    digest = f"{hash_file(file_name)}-{reduction}"
+    image = disk_cache.get(digest, "image")
+    if image is None:
+        image = decode_image_file(file_name, reduction, progress)
+        if image is None:
+            return None, None
+        disk_cache.put(digest, "image", image)
+    elif progress is not None:
+        progress(100)
+    return image, digest
+
+
+# Largest level a tiled source is assembled at when the whole level is needed
+MAX_CONTENT_SIZE = 8192
+
+
+def get_source_level(source, scale, content_only=False):
+    level = get_pyramid_level(source.width(), source.height(), scale)
+    if content_only and isinstance(source, TiledImage):
+        while max(source.level_size(level)) > MAX_CONTENT_SIZE:
+            level += 1
+    return level
+
+
+class Engine(object):
+    """Staged, cached renderer for one image.
+
+    The caches are not locked: use one Engine per image and thread. The image
+    is passed on every call together with a generation that changes whenever
+    the image does, so a caller can swap images without touching the engine.
+    source is the QImage that is displayed, image the gray, BGR or BGRA
+    array the outline is computed from.
+    """
+
+    def __init__(self):
+        # Outputs of the render stages, name -> (key, image)
+        self.stage_cache = {}
+        # Caches for the outline path. The grayscale image only depends on the
+        # loaded image, the contour buffer also on thresholds and color.
+        self.gray_cache = None
+        self.gray_cache_key = None
+        # Half-resolution pyramids of the display image and the grayscale
+        # image, built lazily per level; renders start from the nearest level.
+        self.pyramid_key = None
+        self.image_levels = []
+        self.gray_levels = []
+        self.contour_cache = None
+        self.contour_cache_key = None
+        # Sobel derivatives of one gray level, kept across threshold changes
+        self.gradient_key = None
+        self.gradients = None
+        # Flake labels of the image, largest first, and their boundaries per
+        # pyramid level; selecting a flake is a lookup on the boundaries
+        self.segment_key = None
+        self.segment_labels = None
+        self.segment_boundaries = {}
+        self.frame_buffers = FrameBuffers()
+        # Optional DiskCache, used for images that come with a digest
+        self.disk_cache = None
+        self.digest = None
+        # Optional callable(stage, seconds, hit), told about every stage run
+        # or cache hit; None keeps the render path free of timing calls
+        self.observer = None
+
+    def render(self, source, image, generation, params, content_only=False, digest=None):
+        """Return (key, QImage); the key changes whenever the frame does.
+
+        Each stage keeps its output and is only re-run when its own key
+        changes; a key includes the key of the stage before it. Cropping
+        happens first, in source coordinates, so the outline, scale and
+        rotate stages only process the visible region. With content_only the
+        caller crops and transforms at paint time and gets the whole level.
+        digest, with a disk_cache, persists the arrays that only depend on the
+        image (gray pyramid, gradients, flake labels) across sessions.
+        """
+        self.digest = digest
+        if isinstance(image, TiledImage):
+            return self.render_tiled(image, generation, params, content_only)
+        level = get_pyramid_level(source.width(), source.height(), params.scale)
+        level_image = self.get_image_level(source, generation, level)
+        if content_only:
+            crop = (0, 0, level_image.width(), level_image.height())
+        else:
+            crop = get_crop_rect(level_image.width(), level_image.height(), params.cuts)
+        key, frame = self.run_stage("source", (generation, level), lambda: level_image)
+        if params.outline and params.vector:
+            # Traced from the gray pyramid, the cropped image is not needed
+            return self.render_vector(key, source, image, generation, level, crop, params, content_only)
+        if not content_only:
+            key, frame = self.run_stage("crop", (key, crop), lambda: crop_image(frame, crop))
+        if params.outline:
+            key, frame = self.run_stage("outline", (key, params.outline_key(), params.color),
+                                        lambda: self.get_contour_qimage(source, image, generation, level, crop, params))
+        if content_only:
+            return key, frame
+        return self.transform(key, frame, level, params)
+
+    def render_tiled(self, image, generation, params, content_only):
+        # Only the tiles under the crop are fetched, and Canny runs per tile
+        level = get_source_level(image, params.scale, content_only)
+        width, height = image.level_size(level)
+        crop = (0, 0, width, height) if content_only else get_crop_rect(width, height, params.cuts)
+        if params.outline and params.vector:
+            return self.render_vector((generation, level), image, image, generation, level, crop, params, content_only)
+        key, frame = self.run_stage("crop", (generation, level, crop), lambda: array_to_qimage(image.read_region(level, *crop)))
+        if params.outline:
+            key, frame = self.run_stage("outline", (key, params.outline_key(), params.color),
+                                        lambda: self.get_contour_qimage(image, image, generation, level, crop, params))
+        if content_only:
+            return key, frame
+        return self.transform(key, frame, level, params)
+
+    def render_vector(self, key, source, image, generation, level, crop, params, content_only):
+        # The traced outline does not depend on the color, only the paint does.
+        # content_only returns the VectorOutline itself, for backends that
+        # paint paths.
+        key, outline = self.run_stage("outline", (key, crop, params.outline_key(), "vector", params.tolerance),
+                                      lambda: self.get_vector_outline(source, image, generation, level, crop, params))
+        if content_only:
+            return key, outline
+        key, frame = self.run_stage("paint", (key, params.scale, params.angle, params.mirror, params.color, params.smooth),
+                                    lambda: outline.render(params.scale * 2 ** level, params.angle, params.mirror, params.color, params.smooth))
+        if params.bake_alpha:
+            key, frame = self.run_stage("opacity", (key, params.alpha), lambda: apply_opacity(frame, params.alpha))
+        return key, frame
+
+    def get_vector_outline(self, source, image, generation, level, crop, params):
+        edges = self.get_edges(source, image, generation, level, crop, params)
+        path = self.timed("vectorize", lambda: contours_to_path(trace_contours(edges, params.tolerance)))
+        return VectorOutline(path, crop[2], crop[3])
+
+    def get_edges(self, source, image, generation, level, crop, params):
+        # Edge map of the crop at a level: flake boundaries when segmenting,
+        # Canny otherwise
+        x, y, w, h = crop
+        if params.segment:
+            boundaries = self.get_segment_boundaries(source, image, generation, level, params)[y:y + h, x:x + w]
+            return self.timed("select", lambda: select_flakes(boundaries, params.flake))
+        if isinstance(image, TiledImage):
+            return self.timed("canny", lambda: image.read_edges(level, *crop, params.threshold1, params.threshold2))
+        # Edge detection only runs on the cropped region, from the cached
+        # gradients: a threshold change skips the Sobel pass
+        gradients = self.get_gradient_level(source, image, generation, level)[:, y:y + h, x:x + w]
+        return self.timed("canny", lambda: detect_edges_from_gradients(gradients, params.threshold1, params.threshold2))
+
+    def get_segment_labels(self, image, generation, params):
+        # Segmented once per image and setting, at full resolution or, for a
+        # tiled image, at the largest level that fits in MAX_CONTENT_SIZE
+        key = (generation, params.color_space, params.min_area)
+        if self.segment_key != key:
+            if isinstance(image, TiledImage):
+                pixels = image.read_region(get_source_level(image, 1.0, content_only=True), 0, 0, image.width(), image.height())
+            else:
+                pixels = image
+            self.segment_labels = self.timed("segment", lambda: self.load_or_build(
+                f"labels-{params.color_space}-{params.min_area}", lambda: segment_flakes(pixels, params.color_space, params.min_area)))
+            self.segment_boundaries = {}
+            self.segment_key = key
+        return self.segment_labels
+
+    def get_segment_boundaries(self, source, image, generation, level, params):
+        labels = self.get_segment_labels(image, generation, params)
+        if level not in self.segment_boundaries:
+            width, height = get_level_size(source.width(), source.height(), level)
+            if labels.shape != (height, width):
+                # Nearest neighbour keeps the labels intact
+                rows = np.arange(height) * labels.shape[0] // height
+                columns = np.arange(width) * labels.shape[1] // width
+                labels = labels[rows[:, None], columns]
+            self.segment_boundaries[level] = self.timed("boundaries", lambda: get_flake_boundaries(labels))
+        return self.segment_boundaries[level]
+
+    def transform(self, key, frame, level, params):
+        quality = Qt.SmoothTransformation if params.smooth else Qt.FastTransformation
+        # The pyramid level already applied part of the scale
+        key, frame = self.run_stage("scale", (key, params.outline, params.scale, params.smooth), lambda: scale_image(frame, params.scale * 2 ** level, quality))
+        key, frame = self.run_stage("rotate", (key, params.angle, params.mirror, params.smooth), lambda: rotate_image(frame, params.angle, params.mirror, quality))
+        if params.bake_alpha:
+            key, frame = self.run_stage("opacity", (key, params.alpha), lambda: apply_opacity(frame, params.alpha))
+        return key, frame
+
+    def render_array(self, source, image, generation, params):
+        return qimage_to_array(self.render(source, image, generation, params)[1])
+
+    def run_stage(self, name, key, build):
+        cached = self.stage_cache.get(name)
+        # Read once: the GUI thread may swap the observer during a render
+        observer = self.observer
+        if cached is not None and cached[0] == key:
+            if observer is not None:
+                observer(name, 0.0, True)
+            return cached
+        self.stage_cache[name] = (key, self.timed(name, build))
+        return self.stage_cache[name]
+
+    def timed(self, name, build):
+        observer = self.observer
+        if observer is None:
+            return build()
+        start = time.perf_counter()
+        result = build()
+        observer(name, time.perf_counter() - start, False)
+        return result
+
+    def load_or_build(self, name, build):
+        # Arrays that only depend on the image go through the disk cache
+        if self.disk_cache is None or self.digest is None:
+            return build()
+        return self.disk_cache.get_or_build(self.digest, name, build)
+
+    def get_gray_image(self, image, generation):
+        if self.gray_cache_key != generation:
+            self.gray_cache = self.load_or_build("gray", lambda: to_gray(image))
+            self.gray_cache_key = generation
+        return self.gray_cache
+
+    def reset_pyramid(self, source, generation):
+        if self.pyramid_key != generation:
+            self.image_levels = [source]
+            self.gray_levels = []
+            self.pyramid_key = generation
+
+    def get_image_level(self, source, generation, level):
+        self.reset_pyramid(source, generation)
+        while len(self.image_levels) <= level:
+            previous = self.image_levels[-1]
+            # Same size convention as cv2.pyrDown so both pyramids line up
+            size = QSize((previous.width() + 1) // 2, (previous.height() + 1) // 2)
+            self.image_levels.append(previous.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+        return self.image_levels[level]
+
+    def get_gray_level(self, source, image, generation, level):
+        self.reset_pyramid(source, generation)
+        if not self.gray_levels:
+            self.gray_levels.append(self.get_gray_image(image, generation))
+        while len(self.gray_levels) <= level:
+            previous = self.gray_levels[-1]
+            self.gray_levels.append(self.load_or_build(f"gray{len(self.gray_levels)}", lambda: cv2.pyrDown(previous)))
+        return self.gray_levels[level]
+
+    def get_gradient_level(self, source, image, generation, level):
+        # Only for the current level: two int16 planes, twice the gray image
+        if self.gradient_key != (generation, level):
+            gray = self.get_gray_level(source, image, generation, level)
+            self.gradients = self.timed("gradient", lambda: self.load_or_build(f"gradient{level}", lambda: get_gradients(gray)))
+            self.gradient_key = (generation, level)
+        return self.gradients
+
+    def get_contour_qimage(self, source, image, generation, level, crop, params):
+        key = (generation, level, crop, params.outline_key(), params.color)
+        if self.contour_cache_key != key:
+            # Timed apart, they are the two halves of the outline stage
+            edges = self.get_edges(source, image, generation, level, crop, params)
+            buffer = self.frame_buffers.acquire("outline", edges.shape + (4,))
+            contour_image = self.timed("colorize", lambda: colorize_edges(edges, params.color, out=buffer))
+            qimage = self.frame_buffers.wrap("outline", contour_image)
+            self.contour_cache = (contour_image, qimage)
+            self.contour_cache_key = key
+        return self.contour_cache[1]
@@ -1,11 +1,24 @@
 import cv2
-from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QLabel, QVBoxLayout, QWidget
-from PySide6.QtGui import QPixmap, QTransform, QImage, QPainter
-from PySide6.QtCore import Qt, Signal, QSize, QPoint
+from PySide6.QtWidgets import (QApplication, QMainWindow, QFileDialog, QLabel, QVBoxLayout, QWidget, QGraphicsOpacityEffect, QInputDialog,
+    QGraphicsScene, QGraphicsView, QGraphicsRectItem, QGraphicsPixmapItem, QGraphicsPathItem, QGraphicsItem, QFrame, QProgressBar,
+    QDialog, QHBoxLayout, QToolButton)
+from PySide6.QtGui import QTransform, QImage, QPainter, QPainterPath, QPixmap, QIcon, QPen, QActionGroup, QMatrix4x4, QVector2D, QVector4D, QSurfaceFormat, QOpenGLContext
+from PySide6.QtOpenGL import QOpenGLShaderProgram, QOpenGLShader, QOpenGLTexture, QOpenGLBuffer, QOpenGLVertexArrayObject
+from PySide6.QtOpenGLWidgets import QOpenGLWidget
+from PySide6.QtCore import Qt, Signal, QSize, QPoint, QTimer, QObject, QRunnable, QThreadPool, QRectF
 from transfer_shape_ui import Ui_TransferShape
 from control_ui import Ui_Controller
+from engine import Engine, RenderParams, FrameProfiler, TiledImage, VectorOutline, DiskCache, open_image_source, load_image_source, array_to_qimage, OUTLINE_COLORS, get_contour_image, get_crop_rect, get_content_key, get_outline_pen, SEGMENT_COLOR_SPACES, sweep_thresholds, apply_opacity, compose_images
 import sys
+import os
 import math
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import queue
+import threading
+from collections import deque
 import numpy as np
 
 #1234
@@ -94,6 +107,28 @@ class Controller(QMainWindow):
     def on_color_changed(self, color):
         self.colorChanged.emit(color)
 
+    def show_layer(self, layer):
+        # Reflect the selected layer without sending its values back
+        widgets = (self.ui.lineEdit_Size, self.ui.lineEdit_Angle, self.ui.QSliderCutXLeft, self.ui.QSliderCutXRight,
+                   self.ui.QSliderCutYLeft, self.ui.QSliderCutYRight, self.ui.QSliderTransparency, self.ui.QCheckBoxMirror,
+                   self.ui.QCheckBoxOutline, self.ui.QSlider_threshold1, self.ui.QSlider_threshold2, self.ui.comboBoxColor)
+        for widget in widgets:
+            widget.blockSignals(True)
+        self.ui.lineEdit_Size.setValue(layer.current_scale)
+        self.ui.lineEdit_Angle.setValue(layer.current_angle)
+        self.ui.QSliderCutXLeft.setValue(layer.cut_x_left)
+        self.ui.QSliderCutXRight.setValue(layer.cut_x_right)
+        self.ui.QSliderCutYLeft.setValue(layer.cut_y_top)
+        self.ui.QSliderCutYRight.setValue(layer.cut_y_bottom)
+        self.ui.QSliderTransparency.setValue(round(layer.current_transparency * 100 / 255))
+        self.ui.QCheckBoxMirror.setChecked(layer.mirror_enabled)
+        self.ui.QCheckBoxOutline.setChecked(layer.outline_enabled)
+        self.ui.QSlider_threshold1.setValue(layer.threshold1)
+        self.ui.QSlider_threshold2.setValue(layer.threshold2)
+        self.ui.comboBoxColor.setCurrentText(layer.outline_color)
+        for widget in widgets:
+            widget.blockSignals(False)
+
     def on_size_down(self):
         try:
             current_size = self.ui.lineEdit_Size.value()
@@ -178,6 +213,563 @@ class ChildWindowMove(QMainWindow):
         else:
             super(ChildWindowMove, self).mouseMoveEvent(event)
 
+class RenderSignals(QObject):
+    finished = Signal(int, object, object)
+
+
+class RenderTask(QRunnable):
+    def __init__(self, window, generation, params, signals):
+        super(RenderTask, self).__init__()
+        self.window = window
+        self.generation = generation
+        self.params = params
+        self.signals = signals
+
+    def run(self):
+        # finished is always emitted, with None on failure, so the window
+        # never waits for a render that is not coming
+        key, image = None, None
+        try:
+            profiler = self.window.profiler
+            start = time.perf_counter()
+            key, image = self.window.render_stack(self.params)
+            if profiler is not None:
+                profiler.add_frame(time.perf_counter() - start)
+        except Exception as error:
+            print(f"Render failed: {error!r}")
+            key, image = None, None
+        finally:
+            self.signals.finished.emit(self.generation, key, image)
+
+
+class LoadSignals(QObject):
+    progress = Signal(int)
+    finished = Signal(object)
+
+
+class LoadTask(QRunnable):
+    def __init__(self, layer, file_name, reduction, signals, disk_cache=None):
+        super(LoadTask, self).__init__()
+        self.layer = layer
+        self.file_name = file_name
+        self.reduction = reduction
+        self.signals = signals
+        self.disk_cache = disk_cache
+
+    def run(self):
+        # finished is always emitted, with None on failure, so the progress
+        # bar and the layer never wait for a load that is not coming
+        image, digest = None, None
+        try:
+            image, digest = load_image_source(self.file_name, self.reduction, self.signals.progress.emit, self.disk_cache)
+        except Exception as error:
+            print(f"Cannot read {self.file_name}: {error!r}")
+            image, digest = None, None
+        finally:
+            self.signals.finished.emit((self.layer, self.file_name, self.reduction, image, digest))
+
+
+class SweepSignals(QObject):
+    finished = Signal(object)
+
+
+class SweepTask(QRunnable):
+    def __init__(self, layer, image, signals):
+        super(SweepTask, self).__init__()
+        self.layer = layer
+        self.image = image
+        self.signals = signals
+
+    def run(self):
+        # finished is always emitted, with None on failure, so the action is
+        # enabled again whatever happens
+        result = None
+        try:
+            result = sweep_thresholds(self.image)
+        except Exception as error:
+            print(f"Threshold sweep failed: {error!r}")
+            result = None
+        finally:
+            self.signals.finished.emit((self.layer, self.image, result))
+
+
+class ThresholdDialog(QDialog):
+    """Thumbnails of the best threshold pairs of a sweep; a click picks one."""
+    THUMBNAIL_WIDTH = 200
+
+    def __init__(self, candidates, preview, color_name, parent=None):
+        super(ThresholdDialog, self).__init__(parent)
+        self.setWindowTitle("Auto Thresholds")
+        self.thresholds = None
+        layout = QHBoxLayout(self)
+        for score, threshold1, threshold2, edges in candidates:
+            thumbnail = self.make_thumbnail(preview, edges, color_name)
+            button = QToolButton(self)
+            button.setToolButtonStyle(Qt.ToolButtonTextUnderIcon)
+            button.setIcon(QIcon(QPixmap.fromImage(thumbnail)))
+            button.setIconSize(thumbnail.size())
+            button.setText(f"{threshold1} / {threshold2}")
+            button.setToolTip(f"Score {score:.2f}")
+            button.clicked.connect(lambda checked=False, pair=(threshold1, threshold2): self.choose(pair))
+            layout.addWidget(button)
+
+    def make_thumbnail(self, preview, edges, color_name):
+        # Edges drawn over the image, after downsizing so they stay visible
+        scale = self.THUMBNAIL_WIDTH / preview.shape[1]
+        image = cv2.resize(preview, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        image = np.ascontiguousarray(image[:, :, :3])
+        mask = cv2.resize(edges, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_AREA) > 0
+        image[mask] = OUTLINE_COLORS.get(color_name, OUTLINE_COLORS["White"])[:3]
+        return array_to_qimage(image).copy()
+
+    def choose(self, thresholds):
+        self.thresholds = thresholds
+        self.accept()
+
+
+class ImageLabel(QLabel):
+    """QLabel that paints a QImage as is, without a QPixmap copy."""
+
+    def __init__(self, parent=None):
+        super(ImageLabel, self).__init__(parent)
+        self.image = QImage()
+
+    def setImage(self, image):
+        self.image = image
+        self.updateGeometry()
+        self.update()
+
+    def sizeHint(self):
+        if self.image.isNull():
+            return super(ImageLabel, self).sizeHint()
+        return self.image.size()
+
+    def minimumSizeHint(self):
+        return self.sizeHint()
+
+    def paintEvent(self, event):
+        if self.image.isNull():
+            super(ImageLabel, self).paintEvent(event)
+            return
+        painter = QPainter(self)
+        painter.drawImage((self.width() - self.image.width()) // 2, (self.height() - self.image.height()) // 2, self.image)
+        painter.end()
+
+
+# OpenGL enums used by GLOverlayRenderer
+GL_COLOR_BUFFER_BIT = 0x4000
+GL_BLEND = 0x0BE2
+GL_ONE = 1
+GL_ONE_MINUS_SRC_ALPHA = 0x0303
+GL_FLOAT = 0x1406
+GL_TRIANGLE_STRIP = 0x0005
+GL_MAX_TEXTURE_SIZE = 0x0D33
+
+# GLSL without a #version line and with precision qualifiers compiles on
+# desktop GL 2.x (including Mesa llvmpipe) as well as on OpenGL ES 2.
+GL_VERTEX_SHADER = """
+attribute highp vec2 a_corner;
+uniform highp vec4 u_crop;
+uniform highp vec2 u_size;
+uniform highp mat4 u_matrix;
+varying highp vec2 v_texcoord;
+void main() {
+    v_texcoord = u_crop.xy + a_corner * u_crop.zw;
+    highp vec2 position = (a_corner - 0.5) * u_crop.zw * u_size;
+    gl_Position = u_matrix * vec4(position, 0.0, 1.0);
+}
+"""
+
+GL_FRAGMENT_SHADER = """
+uniform sampler2D u_image;
+uniform sampler2D u_outline;
+uniform lowp float u_use_outline;
+uniform lowp float u_alpha;
+varying highp vec2 v_texcoord;
+void main() {
+    lowp vec4 color = mix(texture2D(u_image, v_texcoord), texture2D(u_outline, v_texcoord), u_use_outline);
+    gl_FragColor = vec4(color.rgb * color.a, color.a) * u_alpha;
+}
+"""
+
+
+class GLOverlayRenderer(object):
+    """Draws the overlay from two textures, the image and its outline.
+
+    Scale, rotation, mirror, crop and alpha are shader uniforms, so a
+    geometry change is one draw call. All methods need a current context.
+    """
+
+    def __init__(self):
+        self.program = None
+        # name -> (texture, content key, pyramid level)
+        self.textures = {}
+        self.geometry = None
+        self.max_texture_size = 2048
+
+    def initialize(self, functions):
+        self.functions = functions
+        self.program = QOpenGLShaderProgram()
+        if not (self.program.addShaderFromSourceCode(QOpenGLShader.Vertex, GL_VERTEX_SHADER)
+                and self.program.addShaderFromSourceCode(QOpenGLShader.Fragment, GL_FRAGMENT_SHADER)
+                and self.program.link()):
+            print(self.program.log())
+            self.program = None
+            return False
+        self.vao = QOpenGLVertexArrayObject()
+        self.vao.create()
+        self.vao.bind()
+        self.vbo = QOpenGLBuffer()
+        self.vbo.create()
+        self.vbo.bind()
+        corners = np.array([0, 0, 1, 0, 0, 1, 1, 1], dtype=np.float32)
+        self.vbo.allocate(corners.tobytes(), corners.nbytes)
+        self.program.bind()
+        corner_location = self.program.attributeLocation("a_corner")
+        self.program.enableAttributeArray(corner_location)
+        self.program.setAttributeBuffer(corner_location, GL_FLOAT, 0, 2)
+        self.program.release()
+        self.vbo.release()
+        self.vao.release()
+        self.max_texture_size = functions.glGetIntegerv(GL_MAX_TEXTURE_SIZE)
+        # Stand-in until real content is uploaded
+        empty = QImage(1, 1, QImage.Format_ARGB32)
+        empty.fill(Qt.transparent)
+        for name in ("image", "outline"):
+            self.set_texture(name, empty, None, 0)
+        return True
+
+    def has_texture(self, name, key):
+        return name in self.textures and self.textures[name][1] == key
+
+    def set_texture(self, name, image, key, level):
+        # Shrink anything the GL implementation cannot hold; the level keeps
+        # track of the total downscale so geometry stays in source pixels
+        while max(image.width(), image.height()) > self.max_texture_size:
+            image = image.scaled((image.width() + 1) // 2, (image.height() + 1) // 2, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            level += 1
+        if name in self.textures:
+            self.textures[name][0].destroy()
+        texture = QOpenGLTexture(image.convertToFormat(QImage.Format_RGBA8888))
+        texture.setMinMagFilters(QOpenGLTexture.LinearMipMapLinear, QOpenGLTexture.Linear)
+        texture.setWrapMode(QOpenGLTexture.ClampToEdge)
+        self.textures[name] = (texture, key, level)
+
+    def set_geometry(self, cuts, scale, angle, mirror, alpha, use_outline, smooth):
+        self.geometry = (cuts, scale, angle, mirror, alpha, use_outline, smooth)
+
+    def clear(self):
+        self.functions.glClearColor(0, 0, 0, 0)
+        self.functions.glClear(GL_COLOR_BUFFER_BIT)
+
+    def paint(self, width, height):
+        # Blends over what is already in the framebuffer, see clear()
+        f = self.functions
+        if self.program is None or self.geometry is None:
+            return
+        cuts, scale, angle, mirror, alpha, use_outline, smooth = self.geometry
+        texture, key, level = self.textures["outline" if use_outline else "image"]
+        texture_width, texture_height = texture.width(), texture.height()
+        # Same crop convention as the label path, in normalized coordinates
+        cut_x_left, cut_x_right, cut_y_top, cut_y_bottom = cuts
+        x = min(cut_x_left / 100.0, 1.0)
+        y = min(cut_y_top / 100.0, 1.0)
+        w = min(cut_x_right / 100.0, 1.0 - x)
+        h = min(cut_y_bottom / 100.0, 1.0 - y)
+
+        # Applied to points last to first: scale, mirror, rotate, then map
+        # pixels (y down, origin at the center) to clip space
+        matrix = QMatrix4x4()
+        matrix.ortho(-width / 2.0, width / 2.0, height / 2.0, -height / 2.0, -1.0, 1.0)
+        matrix.rotate(angle, 0.0, 0.0, 1.0)
+        if mirror:
+            matrix.scale(-1.0, 1.0)
+        matrix.scale(scale * 2 ** level)
+
+        for name in ("image", "outline"):
+            self.textures[name][0].setMinMagFilters(
+                QOpenGLTexture.LinearMipMapLinear if smooth else QOpenGLTexture.Nearest,
+                QOpenGLTexture.Linear if smooth else QOpenGLTexture.Nearest)
+        f.glEnable(GL_BLEND)
+        f.glBlendFunc(GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+        self.program.bind()
+        self.textures["image"][0].bind(0)
+        self.textures["outline"][0].bind(1)
+        self.program.setUniformValue1i(self.program.uniformLocation("u_image"), 0)
+        self.program.setUniformValue1i(self.program.uniformLocation("u_outline"), 1)
+        self.program.setUniformValue1f(self.program.uniformLocation("u_use_outline"), 1.0 if use_outline else 0.0)
+        self.program.setUniformValue1f(self.program.uniformLocation("u_alpha"), alpha)
+        self.program.setUniformValue(self.program.uniformLocation("u_crop"), QVector4D(x, y, w, h))
+        self.program.setUniformValue(self.program.uniformLocation("u_size"), QVector2D(texture_width, texture_height))
+        self.program.setUniformValue(self.program.uniformLocation("u_matrix"), matrix)
+        self.vao.bind()
+        f.glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+        self.vao.release()
+        self.textures["outline"][0].release(1)
+        self.textures["image"][0].release(0)
+        self.program.release()
+
+    def cleanup(self):
+        for texture, key, level in self.textures.values():
+            texture.destroy()
+        self.textures = {}
+        if self.program is not None:
+            self.vbo.destroy()
+            self.vao.destroy()
+            self.program = None
+
+
+class GLOverlayView(QOpenGLWidget):
+    """QOpenGLWidget that shows the layers through one GLOverlayRenderer each."""
+    ready = Signal(bool)
+
+    def __init__(self, parent=None):
+        super(GLOverlayView, self).__init__(parent)
+        surface_format = QSurfaceFormat()
+        surface_format.setAlphaBufferSize(8)
+        self.setFormat(surface_format)
+        # Lets the translucent window show through the cleared background
+        self.setAttribute(Qt.WA_AlwaysStackOnTop)
+        # layer -> renderer, painted bottom to top in the order of self.layers
+        self.renderers = {}
+        self.layers = []
+        self.initialized = False
+
+    def initializeGL(self):
+        # Compile once up front so a broken driver is reported right away
+        probe = GLOverlayRenderer()
+        self.initialized = probe.initialize(self.context().functions())
+        probe.cleanup()
+        self.context().aboutToBeDestroyed.connect(self.cleanup)
+        # Queued so listeners can safely reshuffle widgets in response
+        QTimer.singleShot(0, lambda: self.ready.emit(self.initialized))
+
+    def cleanup(self):
+        self.makeCurrent()
+        for renderer in self.renderers.values():
+            renderer.cleanup()
+        self.renderers = {}
+        self.doneCurrent()
+
+    def has_texture(self, layer, name, key):
+        return layer in self.renderers and self.renderers[layer].has_texture(name, key)
+
+    def set_layers(self, layers):
+        # Drops the textures of removed layers
+        self.layers = list(layers)
+        removed = [layer for layer in self.renderers if layer not in self.layers]
+        if removed and self.initialized:
+            self.makeCurrent()
+            for layer in removed:
+                self.renderers.pop(layer).cleanup()
+            self.doneCurrent()
+        self.update()
+
+    def set_texture(self, layer, name, image, key, level):
+        if not self.initialized:
+            return
+        self.makeCurrent()
+        if layer not in self.renderers:
+            self.renderers[layer] = GLOverlayRenderer()
+            self.renderers[layer].initialize(self.context().functions())
+        self.renderers[layer].set_texture(name, image, key, level)
+        self.doneCurrent()
+        self.update()
+
+    def set_geometry(self, layer, *geometry):
+        if layer in self.renderers:
+            self.renderers[layer].set_geometry(*geometry)
+            self.update()
+
+    def paintGL(self):
+        functions = self.context().functions()
+        functions.glClearColor(0, 0, 0, 0)
+        functions.glClear(GL_COLOR_BUFFER_BIT)
+        for layer in self.layers:
+            if layer in self.renderers:
+                self.renderers[layer].paint(self.width(), self.height())
+
+
+def make_synthetic_frame(index, width=1280, height=960):
+    # Stand-in for a camera: a flake drifting and turning over a noisy substrate
+    rng = np.random.default_rng(index)
+    frame = rng.integers(110, 130, (height, width, 3), dtype=np.uint8)
+    center = (width / 2 + width / 6 * math.cos(index / 40.0), height / 2 + height / 6 * math.sin(index / 55.0))
+    angles = np.linspace(0, 2 * math.pi, 7, endpoint=False) + index / 90.0
+    radii = min(width, height) * np.array([0.18, 0.22, 0.15, 0.2, 0.24, 0.17, 0.21])
+    points = np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+    cv2.fillPoly(frame, [points.astype(np.int32)], (60, 170, 90))
+    return frame
+
+
+class LiveSignals(QObject):
+    frame = Signal(object)
+
+
+class LiveSource(object):
+    """Frames from a camera, a video file or a synthetic generator.
+
+    A capture thread fills a small queue that drops its oldest frame when it
+    is full, and a processing thread always takes the newest frame, runs the
+    outline on it and hands it to the GUI. A slow consumer therefore sees
+    fresh frames rather than a growing backlog.
+    """
+
+    def __init__(self, source, layer, queue_size=2):
+        self.source = source
+        # The layer that receives the frames and whose outline settings apply
+        self.layer = layer
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.signals = LiveSignals()
+        self.stopped = threading.Event()
+        self.dropped = 0
+        self.capture = None
+        self.threads = []
+
+    def start(self):
+        if self.source != "synthetic":
+            self.capture = cv2.VideoCapture(int(self.source) if self.source.isdigit() else self.source)
+            if not self.capture.isOpened():
+                raise IOError(f"Cannot open live source {self.source}")
+        self.threads = [threading.Thread(target=self.capture_loop, daemon=True),
+                        threading.Thread(target=self.process_loop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        if self.capture is not None:
+            self.capture.release()
+
+    def put(self, item):
+        try:
+            self.frames.put_nowait(item)
+        except queue.Full:
+            try:
+                self.frames.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self.frames.put_nowait(item)
+
+    def capture_loop(self):
+        # Files and the generator play at their nominal rate; cameras pace themselves
+        paced = self.capture is None or not self.source.isdigit()
+        fps = self.capture.get(cv2.CAP_PROP_FPS) if self.capture is not None else 0
+        frame_time = 1.0 / (fps if fps > 0 else 30.0)
+        index = 0
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            if self.capture is None:
+                frame = make_synthetic_frame(index)
+            else:
+                ok, frame = self.capture.read()
+                if not ok:
+                    if paced:
+                        # Loop video files
+                        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        continue
+                    break
+            self.put((frame, time.perf_counter()))
+            index += 1
+            if paced:
+                time.sleep(max(0.0, frame_time - (time.perf_counter() - start)))
+
+    def process_loop(self):
+        layer = self.layer
+        while not self.stopped.is_set():
+            try:
+                frame, captured = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            # Both QImages keep a reference to the array they are built on
+            frame_image = QImage(frame.data, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format_BGR888)
+            outline_image = None
+            if layer.outline_enabled:
+                contour_image = get_contour_image(frame, layer.threshold1, layer.threshold2, layer.outline_color)
+                outline_image = QImage(contour_image.data, contour_image.shape[1], contour_image.shape[0], contour_image.strides[0], QImage.Format_ARGB32)
+            self.signals.frame.emit((frame, frame_image, outline_image, captured))
+
+
+class OverlayLayer(object):
+    """One image of the overlay stack with its own controls and caches.
+
+    The controls and the source are written on the GUI thread only; the
+    render caches below belong to the render thread.
+    """
+    # Forwarded by MainWindow to the active layer
+    ATTRIBUTES = ("current_scale", "current_angle", "cut_x_left", "cut_x_right", "cut_y_top", "cut_y_bottom",
+                  "current_transparency", "mirror_enabled", "outline_enabled", "threshold1", "threshold2", "outline_color",
+                  "source_image", "image", "image_generation", "live_outline", "live_captured",
+                  "segment_outline", "segment_color_space", "segment_min_area", "selected_flake")
+
+    def __init__(self, name):
+        self.name = name
+        self.current_scale = 1.0
+        self.current_angle = 0.0
+        self.cut_x_left = 0
+        self.cut_x_right = 100
+        self.cut_y_top = 0
+        self.cut_y_bottom = 100
+        self.current_transparency = 255
+        self.mirror_enabled = False
+        self.outline_enabled = False
+        self.threshold1 = 100
+        self.threshold2 = 200
+        self.outline_color = "White"
+        # Outline the boundary of segmented flakes instead of the Canny edges
+        self.segment_outline = False
+        self.segment_color_space = "Lab"
+        self.segment_min_area = 500
+        self.selected_flake = 1
+        self.source_image = None
+        self.image = None
+        # Source pixels per loaded pixel, above 1 after a reduced decode
+        self.pixel_size = 1
+        # File being decoded for this layer, if any
+        self.loading = None
+
+        # Bumped whenever the image is replaced; the engine keys its caches on it
+        self.image_generation = 0
+        # Content digest of a decoded file, keys the disk cache; None for
+        # live frames and tiled sources
+        self.image_digest = None
+        # Render caches, only touched by the render thread
+        self.engine = Engine()
+
+        # Live mode: each processed frame replaces the source image
+        self.live_outline = False
+        self.live_captured = None
+
+        # Scene backend: the crop is a clip around the pixmap item, or around
+        # the path item for a vector outline; content key, pyramid level and
+        # size of the content
+        self.scene_clip = QGraphicsRectItem()
+        self.scene_clip.setPen(QPen(Qt.NoPen))
+        self.scene_clip.setFlag(QGraphicsItem.ItemClipsChildrenToShape)
+        self.scene_item = QGraphicsPixmapItem(self.scene_clip)
+        self.scene_path = QGraphicsPathItem(self.scene_clip)
+        self.scene_content_key = None
+        self.scene_level = 0
+        self.scene_size = None
+
+    def clear_scene_content(self):
+        self.scene_item.setPixmap(QPixmap())
+        self.scene_path.setPath(QPainterPath())
+        self.scene_content_key = None
+        self.scene_size = None
+
+    def invalidate_image_cache(self):
+        # Called whenever self.image is replaced. The caches themselves belong
+        # to the render thread; every key contains the generation, so old
+        # entries are simply never hit again.
+        self.image_generation += 1
+
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -187,14 +779,40 @@ class MainWindow(QMainWindow):
         self.setAttribute(Qt.WA_TranslucentBackground)
         self.setWindowFlags(Qt.FramelessWindowHint)
 
-        self.image_label = QLabel(self)
+        self.image_label = ImageLabel(self)
         self.image_label.setAlignment(Qt.AlignCenter)
         self.image_label.setStyleSheet("background-color: rgba(0, 0, 0, 0);")
 
-        layout = QVBoxLayout(self.ui.centralwidget)
-        layout.addWidget(self.image_label)
+        # Transparency is applied when the label is composited, so changing it
+        # does not repaint the pixmap. Export still bakes it into the image.
+        self.label_opacity = True
+        self.opacity_effect = QGraphicsOpacityEffect(self.image_label)
+        self.image_label.setGraphicsEffect(self.opacity_effect)
+
+        # Alternative display backend: the source or outline of each layer is
+        # uploaded once into a scene item, and scale, rotation, mirror, crop
+        # (as a clip) and opacity are item properties applied at paint time.
+        self.scene = QGraphicsScene(self)
+        self.scene_view = QGraphicsView(self.scene, self)
+        self.scene_view.setFrameShape(QFrame.NoFrame)
+        self.scene_view.setStyleSheet("background: transparent;")
+        self.scene_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.scene_view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.scene_view.hide()
+
+        # "label" renders frames on the CPU; "scene" and "gl" only need the
+        # source or outline and apply the geometry at paint time. The OpenGL
+        # view is created the first time it is selected.
+        self.display_backend = "label"
+        self.gl_view = None
+
+        self.image_layout = QVBoxLayout(self.ui.centralwidget)
+        self.image_layout.addWidget(self.image_label)
+        self.image_layout.addWidget(self.scene_view)
 
         self.ui.actionOpen.triggered.connect(self.open_image)
+        self.actionOpenMosaic = self.ui.menuFile.addAction("Open Mosaic Folder...")
+        self.actionOpenMosaic.triggered.connect(self.open_mosaic)
         self.ui.actionClose.triggered.connect(self.close_all_windows)
         self.ui.actionMinimize.triggered.connect(self.showMinimized)
         self.ui.actionMove.triggered.connect(self.create_child_window)
@@ -202,21 +820,134 @@ class MainWindow(QMainWindow):
         self.child_window = None
         self.ui.actionControl.triggered.connect(self.open_control_window)
         self.control_window = None
+        self.actionLabelOpacity = self.ui.menuTools.addAction("Label Opacity")
+        self.actionLabelOpacity.setCheckable(True)
+        self.actionLabelOpacity.setChecked(self.label_opacity)
+        self.actionLabelOpacity.toggled.connect(self.on_label_opacity_changed)
+        # Outlines traced into paths and painted under the transform; the
+        # OpenGL backend keeps the raster outline
+        self.vector_outline = False
+        self.outline_tolerance = 1.0
+        self.actionVectorOutline = self.ui.menuTools.addAction("Vector Outline")
+        self.actionVectorOutline.setCheckable(True)
+        self.actionVectorOutline.toggled.connect(self.on_vector_outline_changed)
+        self.actionOutlineTolerance = self.ui.menuTools.addAction("Outline Simplification...")
+        self.actionOutlineTolerance.triggered.connect(self.set_outline_tolerance)
+        # Segmentation settings belong to the active layer; the segmentation is
+        # cached, so picking a flake is a lookup
+        self.actionSegment = self.ui.menuTools.addAction("Segment Flakes")
+        self.actionSegment.setCheckable(True)
+        self.actionSegment.toggled.connect(self.on_segment_changed)
+        self.actionSegmentation = self.ui.menuTools.addAction("Segmentation...")
+        self.actionSegmentation.triggered.connect(self.set_segmentation)
+        self.actionSelectFlake = self.ui.menuTools.addAction("Select Flake...")
+        self.actionSelectFlake.triggered.connect(self.select_flake)
+        self.actionAutoThresholds = self.ui.menuTools.addAction("Auto Thresholds...")
+        self.actionAutoThresholds.triggered.connect(self.auto_thresholds)
+        # The sweep runs off the GUI thread, the dialog opens when it is done
+        self.sweep_pool = QThreadPool(self)
+        self.sweep_pool.setMaxThreadCount(1)
+        self.sweep_signals = SweepSignals()
+        self.sweep_signals.finished.connect(self.on_thresholds_swept)
+        self.actionFrameRate = self.ui.menuTools.addAction("Max Frame Rate...")
+        self.actionFrameRate.triggered.connect(self.set_max_frame_rate)
+        self.actionPreviewDelay = self.ui.menuTools.addAction("Preview Delay...")
+        self.actionPreviewDelay.triggered.connect(self.set_preview_delay)
+        self.backend_group = QActionGroup(self)
+        for name, text in (("label", "Label Backend"), ("scene", "Scene Backend"), ("gl", "OpenGL Backend")):
+            action = self.ui.menuTools.addAction(text)
+            action.setCheckable(True)
+            action.setChecked(name == self.display_backend)
+            action.setData(name)
+            self.backend_group.addAction(action)
+        self.backend_group.triggered.connect(lambda action: self.set_display_backend(action.data()))
+        self.actionLoadReduction = self.ui.menuTools.addAction("Decode Resolution...")
+        self.actionLoadReduction.triggered.connect(self.set_load_reduction)
+        self.actionLive = self.ui.menuFile.addAction("Live Source")
+        self.actionLive.setCheckable(True)
+        self.actionLive.toggled.connect(self.on_live_toggled)
+
+        # Opt-in stage timings, shown in a small HUD over the image
+        self.profiler = None
+        self.actionProfiler = self.ui.menuTools.addAction("Profiler")
+        self.actionProfiler.setCheckable(True)
+        self.actionProfiler.toggled.connect(self.on_profiler_toggled)
+        self.actionSaveTrace = self.ui.menuTools.addAction("Save Profiler Trace...")
+        self.actionSaveTrace.setEnabled(False)
+        self.actionSaveTrace.triggered.connect(self.save_profiler_trace)
+        self.profiler_hud = QLabel(self)
+        self.profiler_hud.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white; font-family: monospace; padding: 4px;")
+        self.profiler_hud.hide()
+        self.profiler_timer = QTimer(self)
+        self.profiler_timer.timeout.connect(self.update_profiler_hud)
+
+        # Decoded images and what is computed from them are kept on disk,
+        # keyed by file content, so reopening an image skips the work
+        self.disk_cache = open_disk_cache()
+        self.actionDiskCache = self.ui.menuTools.addAction("Disk Cache...")
+        self.actionDiskCache.triggered.connect(self.set_disk_cache_size)
+
+        # Layers are drawn bottom to top; the controls and Open act on the
+        # active layer, whose attributes MainWindow forwards (see below).
+        self.layers = []
+        self.layer = None
+        self.layer_group = QActionGroup(self)
+        self.layer_group.triggered.connect(lambda action: self.select_layer(action.data()))
+        self.menuLayers = self.ui.menubar.addMenu("Layers")
+        self.add_layer()
+
+        # Images are decoded off the GUI thread, optionally at reduced
+        # resolution; a reduced layer is scaled up to keep its size on screen
+        self.load_reduction = 1
+        self.load_pool = QThreadPool(self)
+        self.load_pool.setMaxThreadCount(1)
+        self.load_signals = LoadSignals()
+        self.load_signals.progress.connect(lambda value: self.load_progress.setValue(value))
+        self.load_signals.finished.connect(self.on_image_loaded)
+        self.load_progress = QProgressBar()
+        self.load_progress.setMaximumWidth(160)
+        self.load_progress.hide()
+        self.ui.statusbar.addPermanentWidget(self.load_progress)
 
-        self.current_scale = 1.0
-        self.current_angle = 0.0
         self.current_x_position = 0.0
         self.current_y_position = 0.0
-        self.cut_x_left = 0
-        self.cut_x_right = 100
-        self.cut_y_top = 0
-        self.cut_y_bottom = 100
-        self.current_transparency = 255
-        self.mirror_enabled = False
-        self.outline_enabled = False
-        self.threshold1 = 100
-        self.threshold2 = 200
-        self.outline_color = "White"
+        self.image_export = None
+
+        # Live mode: each processed frame replaces the source image of the
+        # layer that was active when it started
+        self.live_source = None
+        self.live_layer = None
+        self.live_frame_times = deque()
+
+        # Key and image of the composed stack, owned by the render thread
+        self.compose_cache = None
+        self.displayed_key = None
+
+        # Renders run one at a time on a dedicated thread; param_generation is
+        # bumped on every control change so outdated results can be dropped.
+        self.render_pool = QThreadPool(self)
+        self.render_pool.setMaxThreadCount(1)
+        self.render_signals = RenderSignals()
+        self.render_signals.finished.connect(self.on_render_finished)
+        self.param_generation = 0
+        self.render_in_flight = False
+        self.render_pending = False
+
+        # Control changes only store the new value and schedule a render; the
+        # timer merges everything that arrives before the next frame.
+        self.max_frame_rate = 60
+        self.last_render_time = 0.0
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.update_image_size)
+
+        # While controls are moving, frames use fast transforms; one smooth
+        # render follows once nothing has changed for preview_delay ms.
+        self.preview_delay = 250
+        self.fast_preview = False
+        self.refine_timer = QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.timeout.connect(self.on_refine_timeout)
 
         self.setMinimumSize(200, 200)
         self.center_main_window()
@@ -230,11 +961,59 @@ class MainWindow(QMainWindow):
         self.move(x, y)
     
     def open_image(self):
-        file_name, _ = QFileDialog.getOpenFileName(self, "Open Image File", "", "Image Files (*.png *.jpg *.bmp *.jpeg *.gif *.tif *.tiff *.webp)")
+        file_name, _ = QFileDialog.getOpenFileName(self, "Open Image File", "", "Image Files (*.png *.jpg *.bmp *.jpeg *.gif *.tif *.tiff *.webp *.npy)")
         if file_name:
-            self.pixmap = QPixmap(file_name)
-            self.image = cv2.imread(file_name)
-            self.update_image_size()
+            if self.live_layer is self.layer:
+                self.actionLive.setChecked(False)
+            self.load_image_async(file_name)
+
+    def open_mosaic(self):
+        # A folder of r<row>_c<column> tiles, read tile by tile as it is viewed
+        directory = QFileDialog.getExistingDirectory(self, "Open Mosaic Folder")
+        if directory:
+            if self.live_layer is self.layer:
+                self.actionLive.setChecked(False)
+            self.load_image_async(directory)
+
+    def load_image_async(self, file_name):
+        # Decoded on the load thread; the latest request per layer wins
+        self.layer.loading = file_name
+        self.load_progress.setValue(0)
+        self.load_progress.show()
+        self.ui.statusbar.showMessage(f"Loading {os.path.basename(file_name)}...")
+        self.load_pool.start(LoadTask(self.layer, file_name, self.load_reduction, self.load_signals, self.disk_cache))
+
+    def on_image_loaded(self, item):
+        # The reduction the image was decoded with, the setting may have
+        # changed since
+        layer, file_name, reduction, image, digest = item
+        if layer.loading != file_name or layer not in self.layers:
+            return
+        layer.loading = None
+        if not any(other.loading for other in self.layers):
+            self.load_progress.hide()
+        if image is None:
+            self.ui.statusbar.showMessage(f"Cannot read {file_name}", 5000)
+            return
+        self.ui.statusbar.clearMessage()
+        self.set_layer_image(layer, image, reduction, digest)
+        self.update_image_size()
+
+    def set_layer_image(self, layer, image, pixel_size=1, digest=None):
+        # The displayed QImage is a view on the decoded array, no second copy;
+        # a tiled mosaic is its own source and is never decoded as a whole
+        layer.image = image
+        layer.source_image = image if isinstance(image, TiledImage) else array_to_qimage(image)
+        # Tiled sources are read at full resolution whatever the decode setting
+        layer.pixel_size = 1 if isinstance(image, TiledImage) else pixel_size
+        layer.image_digest = digest
+        layer.invalidate_image_cache()
+
+    def set_load_reduction(self):
+        items = ["Full", "1/2", "1/4", "1/8"]
+        item, ok = QInputDialog.getItem(self, "Decode Resolution", "Decode new images at:", items, [1, 2, 4, 8].index(self.load_reduction), False)
+        if ok:
+            self.load_reduction = [1, 2, 4, 8][items.index(item)]
             
     def export_image(self):
         # 确保QApplication已经存在
@@ -246,77 +1025,251 @@ class MainWindow(QMainWindow):
         if file_dialog.exec():
             file_path = file_dialog.selectedFiles()[0]
             
-            if file_path and self.pixmap_export:
-                # 保存pixmap到文件
-                image = self.pixmap_export.toImage()
+            image = self.get_export_image()
+            if file_path and image is not None:
+                # 保存image到文件
                 image.save(file_path)
                 print(f"Image saved to {file_path}")
             else:
                 print("Save operation canceled.")
 
+    def get_export_image(self):
+        if self.display_backend == "gl":
+            return self.gl_view.grabFramebuffer() if self.gl_view.initialized else None
+        if self.display_backend == "scene":
+            if all(layer.scene_size is None for layer in self.layers):
+                return None
+            # Same geometry and opacity as on screen
+            rect = self.scene.sceneRect()
+            image = QImage(rect.size().toSize(), QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            self.scene.render(painter, QRectF(image.rect()), rect)
+            painter.end()
+            return image
+        if self.image_export is None:
+            return None
+        if self.label_opacity and not self.is_composed():
+            return apply_opacity(self.image_export, self.current_transparency)
+        return self.image_export
+
+    def request_render(self):
+        self.param_generation += 1
+        if self.preview_delay > 0:
+            self.fast_preview = True
+            self.refine_timer.start(self.preview_delay)
+        self.schedule_render()
+
+    def on_refine_timeout(self):
+        self.fast_preview = False
+        self.param_generation += 1
+        self.schedule_render()
+
+    def schedule_render(self):
+        if self.render_timer.isActive():
+            return
+        # Never faster than the display refresh or the configured limit
+        refresh_rate = QApplication.primaryScreen().refreshRate() or self.max_frame_rate
+        interval = 1000.0 / min(self.max_frame_rate, refresh_rate)
+        elapsed = (time.perf_counter() - self.last_render_time) * 1000.0
+        self.render_timer.start(max(0, int(interval - elapsed)))
+
+    def set_max_frame_rate(self):
+        value, ok = QInputDialog.getInt(self, "Max Frame Rate", "Frames per second:", self.max_frame_rate, 1, 240)
+        if ok:
+            self.max_frame_rate = value
+
+    def set_preview_delay(self):
+        value, ok = QInputDialog.getInt(self, "Preview Delay", "Smooth render after idle (ms, 0 = always smooth):", self.preview_delay, 0, 5000)
+        if ok:
+            self.preview_delay = value
+
     def update_image_size(self):
-        if hasattr(self, 'pixmap'):
-            if self.outline_enabled:
-                contour_image = self.get_contour_image(self.image, self.threshold1, self.threshold2, self.outline_color)
-                qimage = QImage(contour_image.data, contour_image.shape[1], contour_image.shape[0], contour_image.strides[0], QImage.Format_ARGB32)
-                pixmap = QPixmap.fromImage(qimage)
-            else:
-                pixmap = self.pixmap
-            new_size = pixmap.size() * self.current_scale
-            transformed_pixmap = pixmap.scaled(new_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            transformed_pixmap = self.crop_to_window_size(transformed_pixmap)
-            transform = QTransform().rotate(self.current_angle)
-            if self.mirror_enabled:
-                transform.scale(-1, 1)
-            transformed_pixmap = transformed_pixmap.transformed(transform, Qt.SmoothTransformation)
+        self.render_timer.stop()
+        self.last_render_time = time.perf_counter()
+        params = self.get_render_params()
+        if params:
+            if self.display_backend != "label":
+                # Geometry changes never need a render, only new content does
+                self.update_backend_geometry()
+                if all(self.backend_has_content(layer_params) for layer_params in params):
+                    return
+            if self.render_in_flight:
+                # Picked up as soon as the running render has finished
+                self.render_pending = True
+                return
+            self.render_in_flight = True
+            self.render_params = params
+            self.render_pool.start(RenderTask(self, self.param_generation, params, self.render_signals))
 
-            transparent_pixmap = QPixmap(transformed_pixmap.size())
-            transparent_pixmap.fill(Qt.transparent)
-            
-            painter = QPainter(transparent_pixmap)
-            painter.setOpacity(self.current_transparency / 255.0)
-            painter.drawPixmap(0, 0, transformed_pixmap)
-            painter.end()
+    def is_composed(self):
+        return len([layer for layer in self.layers if layer.source_image is not None]) > 1
 
-            self.image_label.setPixmap(transparent_pixmap)
-            # self.resize_main_window_to_image(transformed_pixmap.size())
-            
-            # 更新pixmap以用于保存
-            self.pixmap_export = transparent_pixmap    
-            
-    def crop_to_window_size(self, pixmap):
-        # Get the size of the window
-        window_size = self.size()  # Assuming this is the MainWindow's size
-        # Create a new pixmap for the cropped area
-        cropped_pixmap = pixmap.copy(pixmap.width()*self.cut_x_left/100, pixmap.height()*self.cut_y_top/100, pixmap.width()*self.cut_x_right/100, pixmap.height()*self.cut_y_bottom/100)
-        print(pixmap.width()+self.current_x_position, pixmap.height()+self.current_y_position)
-        return cropped_pixmap
-    
-    def get_contour_image(self, image, threshold1, threshold2, color_name):
-        # Resize the image
-        height, width = image.shape[:2]
-
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, threshold1, threshold2)
-
-        transparent_image = np.zeros((edges.shape[0], edges.shape[1], 4), dtype=np.uint8)
-
-        color_dict = {
-            "White": [255, 255, 255, 255],
-            "Blue": [255, 0, 0, 255],
-            "Yellow": [0, 255, 255, 255],
-            "Red": [0, 0, 255, 255],
-            "Green": [0, 255, 0, 255],
-            "Gold": [0, 215, 255, 255],
-            "Black": [0, 0, 0, 255]
+    def get_render_params(self):
+        # Snapshot of everything the render reads, taken on the GUI thread,
+        # one entry per layer that has an image
+        return [self.get_layer_params(layer) for layer in self.layers if layer.source_image is not None]
+
+    def get_layer_params(self, layer):
+        return {
+            "layer": layer,
+            "generation": layer.image_generation,
+            "digest": layer.image_digest,
+            "source": layer.source_image,
+            "image": layer.image,
+            "render": RenderParams(
+                scale=layer.current_scale * layer.pixel_size,
+                angle=layer.current_angle,
+                cuts=(layer.cut_x_left, layer.cut_x_right, layer.cut_y_top, layer.cut_y_bottom),
+                mirror=layer.mirror_enabled,
+                # Live frames arrive with their outline already drawn
+                outline=layer.outline_enabled and not layer.live_outline,
+                threshold1=layer.threshold1,
+                threshold2=layer.threshold2,
+                color=layer.outline_color,
+                alpha=layer.current_transparency,
+                # Only the layer being edited previews, the others stay cached
+                smooth=not (self.fast_preview and layer is self.layer),
+                # The label effect or the composition applies the opacity
+                bake_alpha=not (self.label_opacity or self.is_composed()),
+                vector=self.vector_outline and self.display_backend != "gl",
+                tolerance=self.outline_tolerance,
+                segment=layer.segment_outline,
+                flake=layer.selected_flake,
+                color_space=layer.segment_color_space,
+                min_area=layer.segment_min_area),
+            "backend": self.display_backend,
+            "captured": layer.live_captured,
         }
 
-        color = color_dict.get(color_name, [255, 255, 255, 255])
+    def render_stack(self, params):
+        # Runs on the render thread. Every layer keeps its own engine, so
+        # only the layers whose parameters changed are rendered again.
+        results = [self.render_frame(layer_params) for layer_params in params]
+        if params[0]["backend"] != "label":
+            return [key for key, image in results], [image for key, image in results]
+        if len(results) == 1:
+            return results[0]
+        key = tuple((result[0], layer_params["render"].alpha) for result, layer_params in zip(results, params))
+        # Read once: the profiler can be switched off while this runs
+        profiler = self.profiler
+        if self.compose_cache is None or self.compose_cache[0] != key:
+            start = time.perf_counter()
+            # Layers are centered on each other, as a single image is in the label
+            self.compose_cache = (key, compose_images([image for _, image in results], [layer_params["render"].alpha for layer_params in params]))
+            if profiler is not None:
+                profiler.add("compose", time.perf_counter() - start)
+        elif profiler is not None:
+            profiler.add("compose", 0.0, True)
+        return self.compose_cache
+
+    def render_frame(self, params):
+        # The scene and OpenGL backends crop and transform at paint time
+        return params["layer"].engine.render(params["source"], params["image"], params["generation"], params["render"],
+                                             content_only=params["backend"] != "label", digest=params["digest"])
+
+    def on_render_finished(self, generation, key, image):
+        self.render_in_flight = False
+        params = self.render_params
+        if image is None:
+            # The render failed, there is nothing to show
+            pass
+        elif params[0]["backend"] != "label":
+            # Backend content stays valid while only the geometry changes
+            if params[0]["backend"] == self.display_backend:
+                for layer_params, layer_image in zip(params, image):
+                    self.show_backend_content(layer_params, layer_image)
+                self.update_backend_geometry()
+        elif generation == self.param_generation:
+            # Results from before the latest parameter change are dropped, a
+            # newer frame is on its way
+            if self.label_opacity:
+                self.opacity_effect.setOpacity(self.get_label_opacity())
+            if key != self.displayed_key:
+                # Painted directly; the buffers behind it are kept out of reuse
+                self.image_label.setImage(image)
+                for layer_params in params:
+                    layer_params["layer"].engine.frame_buffers.displayed_key = image.cacheKey()
+                # self.resize_main_window_to_image(image.size())
+                self.displayed_key = key
+
+                # 更新image以用于保存
+                self.image_export = image
 
-        transparent_image[edges != 0] = color
-        transparent_image[edges == 0] = [0, 0, 0, 0]
+        if image is not None:
+            # Live status follows every shown frame, whichever backend drew it
+            captured = [layer_params["captured"] for layer_params in params if layer_params["captured"] is not None]
+            if captured:
+                self.update_live_status(captured[0])
 
-        return transparent_image
+        # Start the next render only once the frame on screen has been marked,
+        # so its buffer cannot be reused underneath it
+        if self.render_pending:
+            self.render_pending = False
+            self.update_image_size()
+
+    def get_label_opacity(self):
+        # A composed stack already carries the opacity of every layer
+        return 1.0 if self.is_composed() else self.current_transparency / 255.0
+
+    def backend_has_content(self, params):
+        content_key = get_content_key(params["source"], params["generation"], params["render"])
+        if params["backend"] == "gl":
+            # The image and the outline are separate textures, both kept
+            return self.gl_view.has_texture(params["layer"], "outline" if params["render"].outline else "image", content_key)
+        return content_key == params["layer"].scene_content_key
+
+    def show_backend_content(self, params, image):
+        # The one upload per content change
+        layer = params["layer"]
+        content_key = get_content_key(params["source"], params["generation"], params["render"])
+        # The level is part of the content key
+        level = content_key[1]
+        if params["backend"] == "gl":
+            self.gl_view.set_texture(layer, "outline" if params["render"].outline else "image", image, content_key, level)
+        elif content_key != layer.scene_content_key:
+            layer.clear_scene_content()
+            if isinstance(image, VectorOutline):
+                layer.scene_path.setPath(image.path)
+                layer.scene_path.setPen(get_outline_pen(params["render"].color))
+            else:
+                layer.scene_item.setPixmap(QPixmap.fromImage(image))
+            layer.scene_content_key = content_key
+            layer.scene_level = level
+            layer.scene_size = (image.width(), image.height())
+
+    def update_backend_geometry(self):
+        if self.display_backend == "gl":
+            self.gl_view.set_layers(self.layers)
+            for layer in self.layers:
+                self.gl_view.set_geometry(layer, (layer.cut_x_left, layer.cut_x_right, layer.cut_y_top, layer.cut_y_bottom), layer.current_scale * layer.pixel_size,
+                                          layer.current_angle, layer.mirror_enabled, layer.current_transparency / 255.0,
+                                          layer.outline_enabled and not layer.live_outline, not self.fast_preview)
+            return
+        scene_rect = QRectF()
+        for index, layer in enumerate(self.layers):
+            if layer.scene_size is None:
+                continue
+            x, y, w, h = get_crop_rect(*layer.scene_size, (layer.cut_x_left, layer.cut_x_right, layer.cut_y_top, layer.cut_y_bottom))
+            layer.scene_clip.setRect(x, y, w, h)
+            layer.scene_item.setTransformationMode(Qt.FastTransformation if self.fast_preview else Qt.SmoothTransformation)
+
+            # Applied to points last to first: center the crop, scale, mirror, rotate
+            scale = layer.current_scale * layer.pixel_size * 2 ** layer.scene_level
+            transform = QTransform().rotate(layer.current_angle)
+            if layer.mirror_enabled:
+                transform.scale(-1, 1)
+            transform.scale(scale, scale)
+            transform.translate(-(x + w / 2), -(y + h / 2))
+            layer.scene_clip.setTransform(transform)
+            layer.scene_clip.setOpacity(layer.current_transparency / 255.0)
+            layer.scene_clip.setZValue(index)
+            scene_rect = scene_rect.united(layer.scene_clip.sceneBoundingRect())
+        self.scene.setSceneRect(scene_rect)
+
+    def invalidate_image_cache(self):
+        self.layer.invalidate_image_cache()
 
     def resize_main_window_to_image(self, size):
         diagonal_length = math.sqrt(size.width() ** 2 + size.height() ** 2)
@@ -354,6 +1307,7 @@ class MainWindow(QMainWindow):
             self.control_window.threshold1Changed.connect(self.on_threshold1_changed)
             self.control_window.threshold2Changed.connect(self.on_threshold2_changed)
             self.control_window.colorChanged.connect(self.on_color_changed)
+            self.control_window.show_layer(self.layer)
         
         screen_geometry = QApplication.primaryScreen().geometry()
         control_width = self.control_window.width()
@@ -365,64 +1319,417 @@ class MainWindow(QMainWindow):
 
     def on_scale_changed(self, scale):
         self.current_scale = scale
-        self.update_image_size()
+        self.request_render()
 
     def on_angle_changed(self, angle):
         self.current_angle = angle
-        self.update_image_size()
+        self.request_render()
         
     def on_cut_x_left_changed(self, cut_x_left):
         self.cut_x_left = cut_x_left
-        self.update_image_size()
+        self.request_render()
     
     def on_cut_x_right_changed(self, cut_x_right):
         self.cut_x_right = cut_x_right
-        self.update_image_size()
+        self.request_render()
     
     def on_cut_y_top_changed(self, cut_y_top):
         self.cut_y_top = cut_y_top
-        self.update_image_size()
+        self.request_render()
         
     def on_cut_y_bottom_changed(self, cut_y_bottom):
         self.cut_y_bottom = cut_y_bottom
-        self.update_image_size()
+        self.request_render()
         
         
     def on_transparency_changed(self, transparency):
         self.current_transparency = int((transparency / 100.0) * 255)
-        self.update_image_size()
+        if self.display_backend != "label":
+            self.update_backend_geometry()
+        elif self.label_opacity and not self.is_composed():
+            self.opacity_effect.setOpacity(self.current_transparency / 255.0)
+        elif self.is_composed():
+            # Only the composition changes; no fast preview of the layers
+            self.param_generation += 1
+            self.schedule_render()
+        else:
+            self.request_render()
+
+    def on_label_opacity_changed(self, enabled):
+        self.label_opacity = enabled
+        self.opacity_effect.setEnabled(enabled)
+        self.opacity_effect.setOpacity(self.get_label_opacity() if enabled else 1.0)
+        self.request_render()
+
+    def on_vector_outline_changed(self, enabled):
+        self.vector_outline = enabled
+        self.request_render()
+
+    def set_outline_tolerance(self):
+        value, ok = QInputDialog.getDouble(self, "Outline Simplification", "Tolerance (px, 0 = every edge pixel):", self.outline_tolerance, 0.0, 20.0, 1)
+        if ok:
+            self.outline_tolerance = value
+            self.request_render()
+
+    def on_segment_changed(self, enabled):
+        self.segment_outline = enabled
+        self.request_render()
+
+    def set_segmentation(self):
+        items = list(SEGMENT_COLOR_SPACES)
+        item, ok = QInputDialog.getItem(self, "Segmentation", "Contrast in color space:", items, items.index(self.segment_color_space), False)
+        if not ok:
+            return
+        area, ok = QInputDialog.getInt(self, "Segmentation", "Smallest flake (px):", self.segment_min_area, 1, 10 ** 8)
+        if ok:
+            self.segment_color_space = item
+            self.segment_min_area = area
+            self.request_render()
+
+    def select_flake(self):
+        value, ok = QInputDialog.getInt(self, "Select Flake", "Flake by size (1 = largest, 0 = all):", self.selected_flake, 0, 10000)
+        if ok:
+            self.selected_flake = value
+            self.request_render()
+
+    def auto_thresholds(self):
+        # Sweep on a downsampled copy, then let the user pick from the best
+        if self.layer.image is None:
+            return
+        self.actionAutoThresholds.setEnabled(False)
+        self.ui.statusbar.showMessage("Trying thresholds...")
+        self.sweep_pool.start(SweepTask(self.layer, self.layer.image, self.sweep_signals))
+
+    def on_thresholds_swept(self, item):
+        layer, image, result = item
+        self.actionAutoThresholds.setEnabled(True)
+        self.ui.statusbar.clearMessage()
+        # Dropped if the layer or its image went away meanwhile
+        if result is None or layer not in self.layers or layer.image is not image:
+            return
+        candidates, preview = result
+        dialog = ThresholdDialog(candidates, preview, layer.outline_color, self)
+        if dialog.exec() and dialog.thresholds is not None:
+            layer.threshold1, layer.threshold2 = dialog.thresholds
+            layer.outline_enabled = True
+            if self.control_window is not None and layer is self.layer:
+                self.control_window.show_layer(layer)
+            self.request_render()
+
+    def set_disk_cache_size(self):
+        value, ok = QInputDialog.getInt(self, "Disk Cache", f"Size of {CACHE_DIRECTORY} (MB, 0 = off):",
+                                        self.disk_cache.max_bytes // 1024 ** 2 if self.disk_cache else 0, 0, 1024 ** 2)
+        if not ok:
+            return
+        self.disk_cache = open_disk_cache(value * 1024 ** 2) if value else None
+        if self.disk_cache is not None:
+            self.disk_cache.evict()
+        for layer in self.layers:
+            layer.engine.disk_cache = self.disk_cache
+
+    def set_display_backend(self, backend):
+        if backend == "gl" and self.gl_view is None and not QOpenGLContext().create():
+            print("OpenGL is not available, keeping the current backend")
+            backend = self.display_backend
+        if backend == "gl" and self.gl_view is None:
+            self.gl_view = GLOverlayView(self)
+            self.gl_view.ready.connect(self.on_gl_ready)
+            self.image_layout.addWidget(self.gl_view)
+        self.display_backend = backend
+        self.image_label.setVisible(backend == "label")
+        self.scene_view.setVisible(backend == "scene")
+        if self.gl_view is not None:
+            self.gl_view.setVisible(backend == "gl")
+        if backend != "scene":
+            # Free the uploaded content
+            for layer in self.layers:
+                layer.clear_scene_content()
+        # The label path renders from scratch when it comes back
+        self.displayed_key = None
+        for action in self.backend_group.actions():
+            action.setChecked(action.data() == backend)
+        self.request_render()
+
+    def on_gl_ready(self, ok):
+        if ok:
+            self.request_render()
+        else:
+            print("OpenGL backend unavailable, falling back to the label backend")
+            self.set_display_backend("label")
 
     def on_mirror_changed(self, enabled):
         self.mirror_enabled = enabled
-        self.update_image_size()
+        self.request_render()
 
     def on_outline_changed(self, enabled):
         self.outline_enabled = enabled
-        self.update_image_size()
+        self.request_render()
 
     def on_threshold1_changed(self, value):
         self.threshold1 = value
         if self.outline_enabled:
-            self.update_image_size()
+            self.request_render()
 
     def on_threshold2_changed(self, value):
         self.threshold2 = value
         if self.outline_enabled:
-            self.update_image_size()
+            self.request_render()
 
     def on_color_changed(self, color):
         self.outline_color = color
         if self.outline_enabled:
-            self.update_image_size()
+            self.request_render()
+
+    def on_live_toggled(self, enabled):
+        if enabled:
+            source, ok = QInputDialog.getText(self, "Live Source", "Camera index, video file or 'synthetic':", text="0")
+            if ok and source:
+                self.live_layer = self.layer
+                self.live_source = LiveSource(source, self.live_layer)
+                self.live_source.signals.frame.connect(self.on_live_frame)
+                try:
+                    self.live_source.start()
+                    return
+                except IOError as error:
+                    print(error)
+            self.live_source = None
+            self.live_layer = None
+            self.actionLive.blockSignals(True)
+            self.actionLive.setChecked(False)
+            self.actionLive.blockSignals(False)
+        elif self.live_source is not None:
+            self.live_source.stop()
+            self.live_source = None
+            # The source may be the last frame with its outline drawn in;
+            # rebuild it from the bare frame so the outline setting applies again
+            layer = self.live_layer
+            layer.live_outline = False
+            layer.live_captured = None
+            if layer.image is not None:
+                layer.source_image = array_to_qimage(layer.image)
+                layer.invalidate_image_cache()
+            self.live_layer = None
+            self.live_frame_times.clear()
+            self.ui.statusbar.clearMessage()
+            self.request_render()
+
+    def on_live_frame(self, item):
+        if self.live_source is None:
+            return
+        frame, frame_image, outline_image, captured = item
+        layer = self.live_layer
+        layer.pixel_size = 1
+        layer.image_digest = None
+        layer.image = frame
+        layer.source_image = outline_image if outline_image is not None else frame_image
+        layer.live_outline = outline_image is not None
+        layer.live_captured = captured
+        layer.invalidate_image_cache()
+        # A new frame is not a parameter change, so a render in flight still
+        # gets shown; the scheduler keeps this at most one render per frame
+        self.schedule_render()
+
+    def update_live_status(self, captured):
+        now = time.perf_counter()
+        self.live_frame_times.append(now)
+        while self.live_frame_times[0] < now - 1.0:
+            self.live_frame_times.popleft()
+        self.ui.statusbar.showMessage("Live: %d fps, %.0f ms latency, %d dropped" % (len(self.live_frame_times), (now - captured) * 1000.0, self.live_source.dropped if self.live_source else 0))
+
+    def add_layer(self):
+        layer = OverlayLayer("Layer %d" % (max([int(layer.name.split()[-1]) for layer in self.layers] or [0]) + 1))
+        self.layers.append(layer)
+        layer.engine.observer = self.profiler
+        layer.engine.disk_cache = self.disk_cache
+        self.scene.addItem(layer.scene_clip)
+        self.select_layer(layer)
+        return layer
+
+    def on_add_layer(self):
+        self.add_layer()
+        self.open_image()
+
+    def remove_layer(self):
+        if len(self.layers) == 1:
+            return
+        layer = self.layer
+        if layer is self.live_layer:
+            self.actionLive.setChecked(False)
+        self.layers.remove(layer)
+        self.scene.removeItem(layer.scene_clip)
+        if self.gl_view is not None:
+            self.gl_view.set_layers(self.layers)
+        self.select_layer(self.layers[-1])
+        self.request_render()
+
+    def select_layer(self, layer):
+        self.layer = layer
+        self.update_layer_menu()
+        self.actionSegment.blockSignals(True)
+        self.actionSegment.setChecked(layer.segment_outline)
+        self.actionSegment.blockSignals(False)
+        if self.control_window is not None:
+            self.control_window.show_layer(layer)
+
+    def update_layer_menu(self):
+        for action in self.layer_group.actions():
+            self.layer_group.removeAction(action)
+        self.menuLayers.clear()
+        self.menuLayers.addAction("Add Layer...").triggered.connect(self.on_add_layer)
+        action = self.menuLayers.addAction("Remove Layer")
+        action.setEnabled(len(self.layers) > 1)
+        action.triggered.connect(self.remove_layer)
+        self.menuLayers.addSeparator()
+        for layer in self.layers:
+            action = self.menuLayers.addAction(layer.name)
+            action.setCheckable(True)
+            action.setChecked(layer is self.layer)
+            action.setData(layer)
+            self.layer_group.addAction(action)
+
+    def on_profiler_toggled(self, enabled):
+        self.profiler = FrameProfiler() if enabled else None
+        for layer in self.layers:
+            layer.engine.observer = self.profiler
+        self.actionSaveTrace.setEnabled(enabled)
+        self.profiler_hud.setVisible(enabled)
+        if enabled:
+            self.profiler_timer.start(500)
+            self.update_profiler_hud()
+        else:
+            self.profiler_timer.stop()
+
+    def update_profiler_hud(self):
+        summary = self.profiler.summary()
+        frame = summary.pop("frame", None)
+        lines = ["frame    %6.1f / %6.1f ms p50/p95  (%d)" % (frame["p50_ms"], frame["p95_ms"], frame["runs"]) if frame else "frame    no renders yet"]
+        for name, stats in sorted(summary.items()):
+            lines.append("%-8s %6.1f / %6.1f ms  %3.0f%% cached" % (name, stats["p50_ms"], stats["p95_ms"], stats["hit_rate"] * 100))
+        self.profiler_hud.setText("\n".join(lines))
+        self.profiler_hud.adjustSize()
+        self.profiler_hud.move(8, self.ui.menubar.height() + 8)
+        self.profiler_hud.raise_()
+
+    def save_profiler_trace(self):
+        file_name, _ = QFileDialog.getSaveFileName(self, "Save Profiler Trace", "trace.json", "Trace files (*.json)")
+        if file_name and self.profiler is not None:
+            self.profiler.save_trace(file_name)
+            print(f"Trace saved to {file_name}")
 
     def close_all_windows(self):
+        self.actionLive.setChecked(False)
+        self.load_pool.waitForDone()
+        self.sweep_pool.waitForDone()
+        self.render_pool.waitForDone()
         if self.child_window:
             self.child_window.close()
         if self.control_window:
             self.control_window.close()
         self.close()
 
+def _active_layer_property(name):
+    return property(lambda self: getattr(self.layer, name), lambda self, value: setattr(self.layer, name, value))
+
+
+# The controls, Open and export keep working on self.<attribute>, which
+# reads and writes the active layer
+for _name in OverlayLayer.ATTRIBUTES:
+    setattr(MainWindow, _name, _active_layer_property(_name))
+
+# Disk cache of decoded images, gray pyramids, gradients and flake labels
+CACHE_DIRECTORY = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "transfer_shape")
+
+
+def open_disk_cache(max_bytes=2 * 1024 ** 3):
+    # The cache is optional; without a usable directory the app runs uncached
+    try:
+        return DiskCache(CACHE_DIRECTORY, max_bytes)
+    except OSError as error:
+        print(f"Disk cache disabled: {error}")
+        return None
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".bmp", ".jpeg", ".gif", ".tif", ".tiff", ".webp", ".npy")
+
+# Engine and parameters of a batch worker process, see batch_init
+batch_engine = None
+batch_params = None
+
+
+def batch_init(options):
+    global batch_engine, batch_params
+    batch_engine = Engine()
+    batch_params = RenderParams(scale=options.scale, angle=options.angle, cuts=options.cut, mirror=options.mirror,
+                                outline=options.outline or options.segment, threshold1=options.threshold1, threshold2=options.threshold2,
+                                color=options.color, alpha=int((options.transparency / 100.0) * 255),
+                                vector=options.vector, tolerance=options.tolerance, segment=options.segment, flake=options.flake,
+                                color_space=options.color_space, min_area=options.min_area)
+
+
+def batch_process(input_path, output_path):
+    # What export_image saves from the label: the frame with its opacity baked in
+    start = time.perf_counter()
+    try:
+        image = open_image_source(input_path)
+    except (OSError, ValueError, cv2.error):
+        image = None
+    if image is None:
+        return input_path, None
+    loaded = time.perf_counter()
+    source = image if isinstance(image, TiledImage) else array_to_qimage(image)
+    key, frame = batch_engine.render(source, image, input_path, batch_params)
+    rendered = time.perf_counter()
+    frame.save(output_path)
+    saved = time.perf_counter()
+    return input_path, (loaded - start, rendered - loaded, saved - rendered)
+
+
+def main_batch(argv):
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Render the overlay of every image in a directory without opening a window.")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--angle", type=float, default=0.0)
+    parser.add_argument("--cut", type=int, nargs=4, default=[0, 100, 0, 100], metavar=("X_LEFT", "X_RIGHT", "Y_TOP", "Y_BOTTOM"),
+                        help="cut sliders in percent, as in the control window")
+    parser.add_argument("--transparency", type=int, default=100, help="0-100, as in the control window")
+    parser.add_argument("--mirror", action="store_true")
+    parser.add_argument("--outline", action="store_true")
+    parser.add_argument("--threshold1", type=int, default=100)
+    parser.add_argument("--threshold2", type=int, default=200)
+    parser.add_argument("--color", choices=list(OUTLINE_COLORS), default="White")
+    parser.add_argument("--vector", action="store_true", help="draw the outline as traced paths instead of resampling it")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="vector outline simplification in pixels")
+    parser.add_argument("--segment", action="store_true", help="outline segmented flakes instead of the Canny edges")
+    parser.add_argument("--flake", type=int, default=1, help="flake to outline by size, 1 = largest, 0 = all")
+    parser.add_argument("--color-space", choices=list(SEGMENT_COLOR_SPACES), default="Lab")
+    parser.add_argument("--min-area", type=int, default=500, help="smallest flake in pixels")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    options = parser.parse_args(argv)
+
+    names = sorted(name for name in os.listdir(options.input_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+    os.makedirs(options.output_dir, exist_ok=True)
+    jobs = [(os.path.join(options.input_dir, name), os.path.join(options.output_dir, name + ".png")) for name in names]
+
+    start = time.perf_counter()
+    failed = 0
+    # Qt does not survive a fork, so workers start from a fresh interpreter;
+    # they only need the engine, no QApplication
+    with ProcessPoolExecutor(max_workers=options.workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=batch_init, initargs=(options,)) as executor:
+        for input_path, timing in executor.map(batch_process, [job[0] for job in jobs], [job[1] for job in jobs]):
+            if timing is None:
+                failed += 1
+                print(f"{input_path}: cannot read image")
+            else:
+                print("%s: load %.1f ms, render %.1f ms, save %.1f ms" % ((input_path,) + tuple(t * 1000.0 for t in timing)))
+    print("%d images in %.2f s, %d failed" % (len(jobs), time.perf_counter() - start, failed))
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["batch"]:
+        sys.exit(main_batch(sys.argv[2:]))
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
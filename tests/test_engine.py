@@ -0,0 +1,110 @@
+"""Headless checks of the render pipeline in engine.py."""
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+import pytest
+from PySide6.QtGui import QGuiApplication
+
+import engine
+
+
+@pytest.fixture(scope="module", autouse=True)
+def app():
+    return QGuiApplication.instance() or QGuiApplication([])
+
+
+@pytest.fixture(scope="module")
+def flake():
+    image = np.random.default_rng(0).normal(120, 6, (300, 400, 3)).clip(0, 255).astype(np.uint8)
+    cv2.circle(image, (200, 150), 80, (40, 200, 90), -1)
+    cv2.rectangle(image, (30, 30), (110, 90), (200, 50, 50), -1)
+    return image
+
+
+def render(render_engine, image, params, generation=1):
+    return engine.qimage_to_array(render_engine.render(engine.array_to_qimage(image), image, generation, params)[1])
+
+
+def test_cached_render_matches_fresh_engine(flake):
+    # Every stage key has to change with what the stage depends on
+    cached = engine.Engine()
+    steps = [
+        dict(),
+        dict(angle=30),
+        dict(angle=30, scale=0.4),
+        dict(angle=30, scale=0.4, outline=True),
+        dict(angle=30, scale=0.4, outline=True, threshold1=60, threshold2=120),
+        dict(angle=30, scale=0.4, outline=True, threshold1=60, threshold2=120, color="Red"),
+        dict(angle=30, scale=0.4, outline=True, cuts=(10, 60, 20, 50)),
+        dict(angle=-15, mirror=True, alpha=128, cuts=(10, 60, 20, 50)),
+        dict(angle=-15, mirror=True, alpha=128, smooth=False),
+        dict(outline=True, vector=True, tolerance=2.0, angle=10),
+        dict(outline=True, segment=True, flake=2),
+        dict(outline=True, segment=True, flake=0, color="Blue"),
+        dict(),
+    ]
+    for changes in steps:
+        params = engine.RenderParams(**changes)
+        assert np.array_equal(render(cached, flake, params), render(engine.Engine(), flake, params)), changes
+
+
+def test_new_generation_is_not_served_from_cache(flake):
+    render_engine = engine.Engine()
+    params = engine.RenderParams(outline=True)
+    render(render_engine, flake, params, generation=1)
+    inverted = np.ascontiguousarray(255 - flake)
+    assert np.array_equal(render(render_engine, inverted, params, generation=2), render(engine.Engine(), inverted, params, generation=2))
+
+
+@pytest.mark.parametrize("cuts, rect", [
+    ((0, 100, 0, 100), (0, 0, 400, 300)),
+    ((25, 50, 10, 20), (100, 30, 200, 60)),
+    ((90, 50, 0, 100), (360, 0, 40, 300)),
+    ((100, 100, 100, 100), (399, 299, 1, 1)),
+    ((0, 0, 0, 0), (0, 0, 1, 1)),
+])
+def test_crop_rect_is_clipped_and_never_empty(cuts, rect):
+    assert engine.get_crop_rect(400, 300, cuts) == rect
+
+
+def test_colorize_edges():
+    edges = np.array([[0, 255], [1, 0]], dtype=np.uint8)
+    out = engine.colorize_edges(edges, "Red")
+    assert out.shape == (2, 2, 4)
+    assert out[0, 0].tolist() == [0, 0, 0, 0]
+    assert out[0, 1].tolist() == engine.OUTLINE_COLORS["Red"]
+    assert out[1, 0].tolist() == engine.OUTLINE_COLORS["Red"]
+    # Unknown colors fall back to white, a given buffer is written in place
+    buffer = np.empty((2, 2, 4), dtype=np.uint8)
+    assert engine.colorize_edges(edges, "Mauve", out=buffer) is buffer
+    assert buffer[0, 1].tolist() == engine.OUTLINE_COLORS["White"]
+
+
+@pytest.mark.parametrize("threshold1, threshold2", [(20, 60), (50, 150), (100, 200), (150, 50)])
+def test_edges_from_gradients_match_canny(flake, threshold1, threshold2):
+    gray = engine.to_gray(flake)
+    gradients = engine.get_gradients(gray)
+    assert np.array_equal(engine.detect_edges_from_gradients(gradients, threshold1, threshold2), cv2.Canny(gray, threshold1, threshold2))
+
+
+def test_disk_cache_round_trip_and_eviction(tmp_path):
+    entry = np.arange(1000, dtype=np.uint8)
+    # Room for two entries of about 1.1 KB each
+    cache = engine.DiskCache(str(tmp_path / "cache"), max_bytes=2500)
+    assert cache.get("a", "image") is None
+    cache.put("a", "image", entry)
+    assert np.array_equal(cache.get("a", "image"), entry)
+    cache.put("b", "image", entry)
+    os.utime(cache.path("a", "image"), (1, 1))
+    os.utime(cache.path("b", "image"), (2, 2))
+    # Reading "a" makes "b" the least recently used entry
+    cache.get("a", "image")
+    cache.put("c", "image", entry)
+    assert cache.get("b", "image") is None
+    assert np.array_equal(cache.get("a", "image"), entry)
+    assert np.array_equal(cache.get("c", "image"), entry)